@@ -1,7 +1,7 @@
 import sys
 import csv
 import multimedia_funcs
-BASE_DIR = r"\\research-cifs.unimelb.edu.au\9730-UniversityArchive-Shared\Digitised_Holdings\Registered"
+BASE_DIR = multimedia_funcs.ASSET_ROOT
 
 def move_and_jpeg(csv_file, out_dir):
     with open(csv_file, encoding='utf-8-sig') as f:
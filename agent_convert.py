@@ -17,7 +17,20 @@ def format_strdate(birth, death):
             birth += death
     return birth
 
+# the fields agent rows are made from
+AGENT_FIELDS = [
+    'NamCitedName', 'NotNotes', 'AdmOriginalData', 'NamPartyType', 'AdmPublishWebNoPassword',
+    'BioBirthDate', 'BioDeathDate', 'BioBirthEarliestDate', 'BioDeathLatestDate',
+    'BioCommencementNotes', 'HisBeginDateNotes', 'HisEndDateNotes', 'NamTitle', 'NamFirst',
+    'NamMiddle', 'NamLast', 'NamSuffix', 'NamOtherNames_tab', 'NamOrganisationOtherNames_tab',
+    'NamOrganisationAcronym', 'BioBirthPlace', 'BioDeathPlace', 'NamSpecialities_tab',
+    'NamBusiness_tab', 'NamMobile', 'NamHome', 'NamSex', 'AddWeb', 'AddEmail',
+    'AddPhysStreet', 'AddPhysCity', 'AddPhysState', 'AddPhysPost', 'AddPhysCountry',
+    'AddPostStreet', 'AddPostCity', 'AddPostState', 'AddPostPost', 'AddPostCountry']
+
 class agent(record):
+    __slots__ = ()
+
     def convert_to_row(self, out_dir):
         row = {}
         row['NODE_TITLE'] = self.get('NamCitedName')
@@ -79,7 +92,7 @@ def main(agent_xml, out_dir, log_file=None):
     template_name = 'People-and-Organisations'
     templates.add_template(template_name)
     with TemporaryDirectory(dir=out_dir) as t:
-        for r in agent.parse_xml(agent_xml):
+        for r in agent.parse_xml(agent_xml, AGENT_FIELDS):
             row = r.convert_to_row(out_dir)
             xml_path = Path(t, metadata_funcs.slugify(row['NODE_TITLE']) + '.xml')
             record.serialise_to_xml('eparties', [r], xml_path)
@@ -1,10 +1,22 @@
 import csv
 import argparse
+import heapq
+import json
+import zlib
+from contextlib import ExitStack
+from itertools import groupby
+from operator import itemgetter
+from pathlib import Path
+from tempfile import TemporaryDirectory
 from emu_xml_parser import record
+import emu_sqlite
 
 class ReCollect_report():
-    def __init__(self, csv_file):
+    """Rows from a ReCollect report, with per-field hash indexes built on first
+    lookup or, for index_fields, while reading the csv"""
+    def __init__(self, csv_file, index_fields=()):
         self.rows = []
+        self.indexes = {field: {} for field in index_fields}
         with open(csv_file, encoding='utf-8-sig') as f:
             reader = csv.DictReader(f)
             for row in reader:
@@ -14,24 +26,132 @@ class ReCollect_report():
                     row['Node Title'] = row.pop('Item Title')
                 assert 'Node ID' in row.keys()
                 self.rows.append(row)
+                for field, index in self.indexes.items():
+                    index.setdefault(row.get(field), []).append(row)
+
+    def index(self, fieldname):
+        if fieldname not in self.indexes:
+            index = {}
+            for row in self.rows:
+                index.setdefault(row.get(fieldname), []).append(row)
+            self.indexes[fieldname] = index
+        return self.indexes[fieldname]
 
     def retrieve_row(self, fieldname, value):
-        return [row for row in self.rows if row.get(fieldname) == value]
+        return list(self.index(fieldname).get(value, []))
+
+def mapped_fields(map_to_field, fields_to_map):
+    "the fields to parse from EMu: the field mapped on, and mapped fields wherever they're nested"
+    return [map_to_field] + ['**.' + x for x in fields_to_map]
+
+def mapped_values(r, map_to_field, fields_to_map):
+    "the value a record is mapped to ReCollect on, and the values of its mapped fields"
+    return r.get(map_to_field), ['|'.join(r.findall(x)) for x in fields_to_map]
+
+def parsed_values(emu_xml, map_to_field, fields_to_map):
+    "the irn, mapped value and mapped field values of each record in an export"
+    for r in record.parse_xml(emu_xml, mapped_fields(map_to_field, fields_to_map)):
+        yield r.get('irn'), *mapped_values(r, map_to_field, fields_to_map)
+
+def queried_values(emu_xml, map_to_field, fields_to_map):
+    """the irn, mapped value and mapped field values of each record in an export,
+    queried from its sqlite database (see emu_sqlite) rather than parsed.
+    Values of a field found at several levels of a record are joined in
+    document order, as they are when the export is parsed."""
+    export = emu_sqlite.export_db(emu_xml)
+    fields = [groupby(export.field_values(x), key=itemgetter(0)) for x in fields_to_map]
+    heads = [next(x, (None, None)) for x in fields]
+    for seq, irn, map_value in export.top_values('irn', map_to_field):
+        values = []
+        for n, (found, group) in enumerate(heads):
+            if found == seq:
+                values.append('|'.join(value for _, value in group))
+                heads[n] = next(fields[n], (None, None))
+            else:
+                values.append('')
+        yield irn, map_value, values
+    export.close()
+
+def indexed_values(emu_xml, node_ids, map_on_field, map_to_field, fields_to_map):
+    """the irn, mapped value and mapped field values of just the records in an
+    export with a mapped value in the ReCollect report, read through the
+    export's offset index (see record.load_many), so map_to_field has to be
+    irn or EADUnitID"""
+    wanted = [x for x in node_ids.index(map_on_field) if x]
+    for r in record.load_many(emu_xml, map_to_field, wanted, mapped_fields(map_to_field, fields_to_map)):
+        yield r.get('irn'), *mapped_values(r, map_to_field, fields_to_map)
+
+def export_values(emu_xml, map_to_field, fields_to_map, sqlite=False):
+    if sqlite:
+        return queried_values(emu_xml, map_to_field, fields_to_map)
+    return parsed_values(emu_xml, map_to_field, fields_to_map)
+
+def write_updates(writer, node_ids, map_on_field, fields_to_map, map_value, values):
+    for row in node_ids.retrieve_row(map_on_field, map_value):
+        row = {'Node ID': row['Node ID'], 'Node Title': row['Node Title']}
+        row.update(zip(fields_to_map, values))
+        writer.writerow(row)
 
-def main(emu_xml, recollect_csv, output_csv, map_on_field, map_to_field, fields_to_map):
-    node_ids = ReCollect_report(recollect_csv)
+def partition_export(emu_xml, part_dir, map_to_field, fields_to_map, partitions, sqlite=False):
+    """Stream an export into partition files by a hash of irn, keeping only
+    each record's position, irn and mapped values"""
+    part_dir.mkdir()
+    with ExitStack() as stack:
+        parts = [stack.enter_context(open(Path(part_dir, f'{n}.jsonl'), 'w', encoding='utf-8'))
+                 for n in range(partitions)]
+        for seq, (irn, map_value, values) in enumerate(export_values(emu_xml, map_to_field, fields_to_map, sqlite)):
+            n = zlib.crc32(str(irn).encode('utf-8')) % partitions
+            parts[n].write(json.dumps([seq, irn, map_value, values]) + '\n')
+
+def read_partition(fpath):
+    with open(fpath, encoding='utf-8') as f:
+        for line in f:
+            yield json.loads(line)
+
+def changed_records(previous_xml, emu_xml, work_dir, map_to_field, fields_to_map, partitions, sqlite=False):
+    """Compare two exports by irn a partition at a time, so only one partition
+    of the previous export is held in memory, yielding the position, mapped
+    value and mapped field values of records that are new or whose mapped
+    fields have changed, in the order they appear in the new export"""
+    old_dir, new_dir, changed_dir = Path(work_dir, 'old'), Path(work_dir, 'new'), Path(work_dir, 'changed')
+    partition_export(previous_xml, old_dir, map_to_field, fields_to_map, partitions, sqlite)
+    partition_export(emu_xml, new_dir, map_to_field, fields_to_map, partitions, sqlite)
+    changed_dir.mkdir()
+    for n in range(partitions):
+        old = {irn: (map_value, values) for _, irn, map_value, values in read_partition(Path(old_dir, f'{n}.jsonl'))}
+        with open(Path(changed_dir, f'{n}.jsonl'), 'w', encoding='utf-8') as f:
+            for seq, irn, map_value, values in read_partition(Path(new_dir, f'{n}.jsonl')):
+                if old.get(irn) != (map_value, values):
+                    f.write(json.dumps([seq, map_value, values]) + '\n')
+    changed = [read_partition(Path(changed_dir, f'{n}.jsonl')) for n in range(partitions)]
+    for seq, map_value, values in heapq.merge(*changed):
+        yield map_value, values
+
+def main(emu_xml, recollect_csv, output_csv, map_on_field, map_to_field, fields_to_map, previous_xml=None, partitions=64, sqlite=False, indexed=False):
+    """Write ReCollect update rows for records in an EMu export. Given the
+    previous export, only records whose mapped fields have changed since it
+    are written. With sqlite, exports are queried from their sqlite databases
+    (built beside them where they're missing or out of date) instead of
+    being parsed. With indexed (and no previous export), only the records
+    the ReCollect report has rows for are read, through an offset index of
+    the export."""
+    node_ids = ReCollect_report(recollect_csv, index_fields=[map_on_field])
     fieldnames = ['Node ID', 'Node Type', 'Node Title', '#REDACT']
     fieldnames.extend(fields_to_map)
     with open(output_csv, 'w', encoding='utf-8-sig', newline='') as f:
         writer = csv.DictWriter(f, fieldnames=fieldnames)
         writer.writeheader()
-        for r in record.parse_xml(emu_xml):
-            rows = node_ids.retrieve_row(map_on_field, r.get(map_to_field))
-            for row in rows:
-                row = {'Node ID': row['Node ID'], 'Node Title': row['Node Title']}
-                for x in fields_to_map:
-                    row[x] = '|'.join(r.findall(x))
-                writer.writerow(row)
+        if previous_xml is not None:
+            with TemporaryDirectory() as t:
+                for map_value, values in changed_records(previous_xml, emu_xml, t, map_to_field, fields_to_map, partitions, sqlite):
+                    write_updates(writer, node_ids, map_on_field, fields_to_map, map_value, values)
+        else:
+            if indexed:
+                found = indexed_values(emu_xml, node_ids, map_on_field, map_to_field, fields_to_map)
+            else:
+                found = export_values(emu_xml, map_to_field, fields_to_map, sqlite)
+            for _, map_value, values in found:
+                write_updates(writer, node_ids, map_on_field, fields_to_map, map_value, values)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -47,5 +167,21 @@ if __name__ == '__main__':
     parser.add_argument(
         '--fields', '-f', nargs='+',
         help='fields to map from EMu')
+    parser.add_argument(
+        '--previous', '-p',
+        help='previous EMu export; only records whose fields have changed since it are written')
+    parser.add_argument(
+        '--partitions', type=int, default=64,
+        help='number of partitions to compare exports in (more partitions use less memory)')
+    parser.add_argument(
+        '--sqlite', action='store_true',
+        help='query exports from sqlite databases beside them (see emu_sqlite) instead of parsing them')
+    parser.add_argument(
+        '--indexed', action='store_true',
+        help='read only the records in the ReCollect report through an offset index of the export '
+             '(mapping on irn or EADUnitID)')
     args = parser.parse_args()
-    main(args.emu_xml, args.recollect_csv, args.output_csv, *args.map_fields, args.fields)
+    if args.indexed and args.previous is not None:
+        parser.error('--indexed reads only some records, so it can\'t compare with --previous')
+    main(args.emu_xml, args.recollect_csv, args.output_csv, *args.map_fields, args.fields,
+         previous_xml=args.previous, partitions=args.partitions, sqlite=args.sqlite, indexed=args.indexed)
@@ -0,0 +1,199 @@
+import argparse
+import csv
+import json
+import sys
+import logging
+from pathlib import Path
+from functools import partial
+from emu_xml_parser import record, export_source, open_sidecar
+
+logger = logging.getLogger(__name__)
+
+ROOT_TABLE = 'records'
+# records inserted between commits while building a database
+BATCH_SIZE = 5000
+# top level atoms indexed for lookups, where the export has them
+INDEX_FIELDS = ('EADUnitID',)
+# bumped when the tables change, so databases built before are rebuilt
+DB_VERSION = 2
+
+
+def quote(name):
+    "quote a table or column name for sql"
+    return '"' + name.replace('"', '""') + '"'
+
+
+class table_writer():
+    """Writes records into the tables of an export database, creating tables and
+    adding columns as new fields turn up. Rows are numbered in document order
+    and held back to be inserted in batches."""
+    def __init__(self, db):
+        self.db = db
+        self.columns = {}
+        self.rows = {}
+        self.next_id = 1
+        self.records = 0
+        db.execute(f'CREATE TABLE {ROOT_TABLE} (irn TEXT PRIMARY KEY, seq INTEGER, atom_pos TEXT)')
+        self.columns[ROOT_TABLE] = {'irn', 'seq', 'atom_pos'}
+
+    def table(self, name, parent):
+        "the columns of a table of nested rows, creating it if it's new"
+        if name not in self.columns:
+            parent_key = f' REFERENCES {quote(parent)} (id)' if parent != ROOT_TABLE else ''
+            self.db.execute(
+                f'CREATE TABLE {quote(name)} (id INTEGER PRIMARY KEY, parent_id INTEGER{parent_key}, '
+                f'root_irn TEXT REFERENCES {ROOT_TABLE} (irn), seq INTEGER, atom_pos TEXT)')
+            self.columns[name] = {'id', 'parent_id', 'root_irn', 'seq', 'atom_pos'}
+        return self.columns[name]
+
+    def add_row(self, table, names, values, atoms):
+        columns = self.columns[table]
+        for name, value in atoms:
+            if name not in columns:
+                self.db.execute(f'ALTER TABLE {quote(table)} ADD COLUMN {quote(name)} TEXT')
+                columns.add(name)
+            names.append(name)
+            values.append(value)
+        self.rows.setdefault((table, tuple(names)), []).append(values)
+
+    def add(self, rec):
+        "add a record and the rows nested in it"
+        self.add_tree(rec, ROOT_TABLE, None, ['seq'], [self.records], rec.get('irn'))
+        self.records += 1
+
+    def add_tree(self, rec, table, row_id, names, values, irn):
+        """add a row and, first, the rows nested in it, numbering rows in document
+        order. Atoms that come after rows nested in the row get the id of the last
+        of those rows as their position (in atom_pos), so values can be put back
+        in document order; other atoms are at the row's own id."""
+        prefix = '' if table == ROOT_TABLE else table + '.'
+        first_id = self.next_id
+        atoms = []
+        positions = {}
+        for name, value in rec.items():
+            if isinstance(value, (list, record)):
+                rows = value if isinstance(value, list) else [value]
+                child = prefix + name
+                for seq, row in enumerate(rows):
+                    self.table(child, table)
+                    child_id = self.next_id
+                    self.next_id += 1
+                    self.add_tree(row, child, child_id, ['id', 'parent_id', 'root_irn', 'seq'], [child_id, row_id, irn, seq], irn)
+            else:
+                atoms.append((name, value))
+                if self.next_id != first_id and value is not None:
+                    positions[name] = self.next_id - 1
+        if positions:
+            names.append('atom_pos')
+            values.append(json.dumps(positions))
+        self.add_row(table, names, values, atoms)
+
+    def flush(self):
+        "insert the rows held back and commit them"
+        for (table, names), rows in self.rows.items():
+            self.db.executemany(
+                f'INSERT INTO {quote(table)} ({", ".join(map(quote, names))}) '
+                f'VALUES ({", ".join("?" * len(names))})', rows)
+        self.db.commit()
+        self.rows = {}
+
+    def index(self, index_fields=()):
+        for table in self.columns:
+            if table != ROOT_TABLE:
+                self.db.execute(f'CREATE INDEX {quote(table + "_parent_id")} ON {quote(table)} (parent_id)')
+                self.db.execute(f'CREATE INDEX {quote(table + "_root_irn")} ON {quote(table)} (root_irn)')
+        for field in index_fields:
+            if field in self.columns[ROOT_TABLE]:
+                self.db.execute(f'CREATE INDEX {quote(ROOT_TABLE + "_" + field)} ON {ROOT_TABLE} ({quote(field)})')
+        self.db.commit()
+
+
+class export_db():
+    """An EMu xml export loaded into a sqlite database beside the export (or at
+    db_file), with top level atoms in the records table and a table of rows for
+    each table and nested tuple, named by its dotted path."""
+    def __init__(self, xml_doc, db_file=None, index_fields=INDEX_FIELDS, workers=1):
+        self.xml_doc = Path(xml_doc)
+        if db_file is None:
+            db_file = self.xml_doc.with_name(self.xml_doc.name + '.sqlite')
+        self.db_file = Path(db_file)
+        self.source = export_source(self.xml_doc, DB_VERSION)
+        self.db = open_sidecar(self.db_file, self.source, partial(self.build, index_fields=index_fields, workers=workers))
+        self.columns = {}
+        for (table,) in self.db.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name != 'meta'"):
+            self.columns[table] = [x[1] for x in self.db.execute(f'PRAGMA table_info({quote(table)})')]
+
+    def build(self, db, index_fields=INDEX_FIELDS, workers=1):
+        logger.info('Loading export ' + self.xml_doc.name)
+        db.execute('PRAGMA journal_mode = OFF')
+        db.execute('PRAGMA synchronous = OFF')
+        writer = table_writer(db)
+        for r in record.parse_xml(self.xml_doc, workers=workers):
+            writer.add(r)
+            if writer.records % BATCH_SIZE == 0:
+                writer.flush()
+        writer.flush()
+        writer.index(index_fields)
+
+    def execute(self, sql, params=()):
+        return self.db.execute(sql, params)
+
+    def top_values(self, *names):
+        "(seq, *values) for top level atoms of every record, in export order"
+        values = [quote(x) if x in self.columns[ROOT_TABLE] else 'NULL' for x in names]
+        return self.db.execute(f'SELECT seq, {", ".join(values)} FROM {ROOT_TABLE} ORDER BY seq')
+
+    def field_values(self, name):
+        """(seq, value) for every value of an atom wherever it's nested, in
+        document order (as findall gives them). Empty atoms are left out."""
+        path = '$.' + json.dumps(name)
+        selects = []
+        params = []
+        for table, columns in self.columns.items():
+            if name not in columns:
+                continue
+            if table == ROOT_TABLE:
+                selects.append(
+                    f'SELECT seq, COALESCE(json_extract(atom_pos, ?), 0), 0, {quote(name)} '
+                    f'FROM {ROOT_TABLE} WHERE {quote(name)} IS NOT NULL')
+            else:
+                selects.append(
+                    f'SELECT r.seq, COALESCE(json_extract(t.atom_pos, ?), t.id), {table.count(".") + 1}, '
+                    f't.{quote(name)} FROM {quote(table)} AS t '
+                    f'JOIN {ROOT_TABLE} AS r ON r.irn = t.root_irn WHERE t.{quote(name)} IS NOT NULL')
+            params.append(path)
+        if not selects:
+            return iter(())
+        # an atom after nested rows shares its position with the last of them,
+        # and comes after it (and after atoms of the rows between them)
+        query = ' UNION ALL '.join(selects) + ' ORDER BY 1, 2, 3 DESC'
+        return ((seq, value) for seq, _, _, value in self.db.execute(query, params))
+
+    def close(self):
+        self.db.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Load an EMu xml export into a sqlite database')
+    parser.add_argument(
+        'input', help='EMu xml export')
+    parser.add_argument(
+        '--db', '-d', help='sqlite database to load into (defaults to one beside the export)')
+    parser.add_argument(
+        '--index', nargs='+', default=list(INDEX_FIELDS),
+        help='top level fields to index')
+    parser.add_argument(
+        '--workers', '-w', type=int, default=1,
+        help='number of processes parsing the export')
+    parser.add_argument(
+        '--query', '-q',
+        help='sql to run against the database, writing the results to stdout as csv')
+    args = parser.parse_args()
+    export = export_db(args.input, db_file=args.db, index_fields=args.index, workers=args.workers)
+    if args.query is not None:
+        cursor = export.execute(args.query)
+        writer = csv.writer(sys.stdout)
+        writer.writerow([x[0] for x in cursor.description])
+        writer.writerows(cursor)
+    export.close()
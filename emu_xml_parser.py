@@ -1,48 +1,629 @@
 from lxml import etree
 import sys
+import os
+import argparse
+import hashlib
+import json
+import pickle
+from pathlib import Path
 from pprint import pprint
-from collections.abc import MutableMapping
+from tempfile import TemporaryFile
+from functools import lru_cache, partial
+from collections.abc import MutableMapping, ItemsView, ValuesView
 import csv
+import io
+import mmap
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import re
+import sqlite3
+from xml.sax.saxutils import quoteattr
+from uuid import uuid4
+
+CHUNK_SIZE = 1024 * 1024
+# largest byte range of an export parsed by one worker when parsing in parallel
+RANGE_SIZE = 16 * 1024 * 1024
+DEFAULT_PARSE_CACHE = Path.home() / '.cache' / 'rms' / 'records'
+# set RMS_PARSE_CACHE to a folder (or 1 for the default folder) to cache parsed
+# records between runs against the same export
+PARSE_CACHE = os.environ.get('RMS_PARSE_CACHE')
+if PARSE_CACHE == '1':
+    PARSE_CACHE = DEFAULT_PARSE_CACHE
+PARSE_CACHE_SIZE = int(os.environ.get('RMS_PARSE_CACHE_SIZE', 20 * 1024 ** 3))
+# bumped when the way records are pickled changes, so older cache entries aren't replayed
+PARSE_CACHE_VERSION = 2
+# top level atoms records can be looked up by in an export's offset index
+OFFSET_FIELDS = ('irn', 'EADUnitID')
+# atom values up to this long (levels, flags, dates, irns) are shared between
+# records, holding up to INTERN_LIMIT distinct values
+INTERN_LENGTH = 32
+INTERN_LIMIT = 250000
+
+# control characters EMu lets into exports that lxml won't parse, plus dashes
+CLEAN_CHARS = {
+    **{chr(x): ' ' for x in range(8)},
+    **{chr(x): '' for x in (19, 20, 24, 25, 28, 29)},
+    '\u2014': '-',
+    '\u2013': '-'}
+CLEAN_PATTERN = re.compile('[' + ''.join(CLEAN_CHARS) + ']')
+
+
+def clean_text(text):
+    "strip or replace characters lxml can't parse in a single pass"
+    return CLEAN_PATTERN.sub(lambda m: CLEAN_CHARS[m[0]], text)
+
+
+def read_clean(xml_doc, chunk_size=CHUNK_SIZE):
+    "read an EMu xml report in chunks, stripping out characters lxml can't parse"
+    with open(xml_doc, encoding='utf-8') as f:
+        for text in iter(lambda: f.read(chunk_size), ''):
+            yield clean_text(text).encode('utf-8')
+
+
+# tags that change depth in an EMu export, plus comments and processing
+# instructions so tags inside them aren't counted
+TAG_PATTERN = re.compile(rb'<!--.*?-->|<\?.*?\?>|<(/?)(table|tuple)\b[^>]*?(/?)>', re.S)
+
+
+def top_level_tags(mm):
+    """Scan an export's table and tuple tags for their depth, yielding the
+    export's table opening tag as ('table', offset, tag), the start of each top
+    level tuple as ('tuple', offset, None), and the table's closing tag as
+    ('end', offset, None)"""
+    depth = 0
+    for m in TAG_PATTERN.finditer(mm):
+        closing, name, empty = m.groups()
+        if name is None:
+            continue
+        if closing:
+            depth -= 1
+            if depth == 0:
+                yield 'end', m.start(), None
+                return
+            continue
+        if depth == 0:
+            yield 'table', m.start(), m.group(0)
+            if empty:
+                return
+        elif depth == 1 and name == b'tuple':
+            yield 'tuple', m.start(), None
+        if not empty:
+            depth += 1
+
+
+def indent_marker(mm, start):
+    """the newline and indentation before the first top level tuple (at start)
+    followed by <tuple, which starts only top level tuples if the export is
+    pretty printed, or None if it isn't"""
+    line_start = mm.rfind(b'\n', 0, start) + 1
+    indent = mm[line_start:start]
+    if line_start and indent and indent.isspace():
+        return b'\n' + indent + b'<tuple'
+
+
+def next_indented_tuple(mm, marker, pos, end):
+    "the offset of the next top level tuple from pos in a pretty printed export, or -1"
+    pos = mm.find(marker, pos, end)
+    while pos != -1:
+        after = mm[pos + len(marker):pos + len(marker) + 1]
+        if after in (b'>', b'/') or after.isspace():
+            return pos + len(marker) - len(b'<tuple')
+        pos = mm.find(marker, pos + 1, end)
+    return -1
+
+
+def indented_ranges(mm, start, marker, range_size):
+    """Split a pretty printed export into ranges by finding top level tuples
+    from their indentation, without scanning the tags in between"""
+    end = mm.rfind(b'</table>')
+    ranges = []
+    offset = next_indented_tuple(mm, marker, start + range_size, end)
+    while offset != -1:
+        ranges.append((start, offset))
+        start = offset
+        offset = next_indented_tuple(mm, marker, start + range_size, end)
+    ranges.append((start, end))
+    return ranges
+
+
+def top_level_offsets(mm):
+    """yield the offset of every top level tuple in a mapped export and then of
+    its table's closing tag, found by indentation where the export is pretty
+    printed and otherwise by scanning tags for depth"""
+    tags = top_level_tags(mm)
+    try:
+        kind, _, _ = next(tags, ('end', None, None))
+        if kind != 'table':
+            return
+        kind, start, _ = next(tags, ('end', None, None))
+        if start is not None:
+            yield start
+        if kind != 'tuple':
+            return
+        marker = indent_marker(mm, start)
+        if marker is None:
+            for _, offset, _ in tags:
+                yield offset
+            return
+    finally:
+        tags.close()
+    end = mm.rfind(b'</table>')
+    offset = next_indented_tuple(mm, marker, start + 1, end)
+    while offset != -1:
+        yield offset
+        offset = next_indented_tuple(mm, marker, offset + 1, end)
+    yield end
+
+
+def split_export(xml_doc, range_size):
+    """Split an EMu export into byte ranges of whole top level tuples, each about
+    range_size bytes. Returns the opening tag of the export's table, to wrap
+    ranges in to parse them, and the ranges as (start, end) offsets. Top level
+    tuples are found by their indentation where the export is pretty printed
+    (as EMu writes them), or otherwise by scanning all tags for their depth."""
+    if Path(xml_doc).stat().st_size == 0:
+        return None, []
+    with open(xml_doc, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        tags = top_level_tags(mm)
+        try:
+            return split_tags(mm, tags, range_size)
+        finally:
+            # the scan holds a view of the map, which has to go before it's closed
+            tags.close()
+
+
+def split_tags(mm, tags, range_size):
+    "split an export into ranges from the scan of its top level tags"
+    kind, _, root = next(tags, ('end', None, None))
+    if kind != 'table':
+        return None, []
+    kind, start, _ = next(tags, ('end', None, None))
+    if kind != 'tuple':
+        return root, []
+    marker = indent_marker(mm, start)
+    if marker is not None:
+        return root, indented_ranges(mm, start, marker, range_size)
+    ranges = []
+    for kind, offset, _ in tags:
+        if kind == 'end':
+            ranges.append((start, offset))
+        elif offset - start >= range_size:
+            ranges.append((start, offset))
+            start = offset
+    return root, ranges
+
+
+def parse_range(record_class, xml_doc, root, start, end, projection=None, where=None):
+    "parse the records in a byte range of an export found by split_export"
+    with open(xml_doc, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    # decoded as read_clean does, including its universal newlines
+    text = io.TextIOWrapper(io.BytesIO(data), encoding='utf-8').read()
+    parser = etree.XMLPullParser(events=('end',), tag='tuple')
+    parser.feed(root)
+    records = []
+    for i in range(0, len(text), CHUNK_SIZE):
+        parser.feed(clean_text(text[i:i + CHUNK_SIZE]).encode('utf-8'))
+        records.extend(record_class.parse_events(parser, projection, where))
+    parser.feed(b'</table>')
+    parser.close()
+    records.extend(record_class.parse_events(parser, projection, where))
+    return records
+
+
+def finished_ranges(pending, ordered):
+    "take parsed ranges off pending, either the first or whichever are done"
+    if ordered:
+        done = [pending.pop(0)]
+    else:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            pending.remove(future)
+    for future in done:
+        yield from future.result()
+
+
+def compile_fields(fields):
+    """Split dotted field paths (such as AssParentObjectRef.EADUnitID) into a
+    projection to parse records with. A path to a tuple or table keeps all of
+    it, * matches any one field name and ** any number of nested names, so
+    **.EADGenreForm keeps EADGenreForm wherever it is nested. The top level irn
+    is always kept."""
+    if fields is None:
+        return None
+    return frozenset(tuple(f.split('.')) for f in fields) | {('irn',)}
+
+
+@lru_cache(maxsize=None)
+def project(projection, name):
+    """The projection to parse a field's contents with: None to keep all of the
+    field, or an empty projection to skip it"""
+    remaining = set()
+    for path in projection:
+        if path[0] == '**':
+            remaining.add(path)
+            path = path[1:]
+            if not path:
+                return None
+        if path[0] in (name, '*'):
+            remaining.add(path[1:])
+    if () in remaining:
+        return None
+    return frozenset(remaining)
+
+
+@lru_cache(maxsize=None)
+def named_in(projection):
+    "whether a projection names fields in a tuple or table, rather than only matching them at any depth"
+    return any(path[0] != '**' for path in projection)
+
+
+def top_atom(tuple_elem, name):
+    "the text of an atom directly within a tuple element"
+    atom = tuple_elem.find(f'atom[@name={quoteattr(name)}]')
+    if atom is not None:
+        return atom.text
+
+
+# predicates are partials of module level functions so they can be sent to
+# worker processes parsing in parallel
+def atom_in(name, values, get):
+    return str(get(name)).lower() in values
+
+def irn_in_range(low, high, get):
+    return low <= int(get('irn')) < high
+
+def irn_in_shard(i, n, get):
+    return int(get('irn')) % n == i
+
+def all_of(predicates, get):
+    return all(p(get) for p in predicates)
+
+
+def atom_equals(name, *values):
+    """a predicate for parse_xml keeping records where a top level atom has one
+    of values, ignoring case"""
+    return partial(atom_in, name, frozenset(v.lower() for v in values))
+
+
+def irn_between(low, high):
+    "a predicate for parse_xml keeping records with irns from low up to (not including) high"
+    return partial(irn_in_range, low, high)
+
+
+def shard(i, n):
+    "a predicate for parse_xml keeping shard i of n shards of an export, split by irn"
+    return partial(irn_in_shard, i, n)
+
+
+def parse_shard(text):
+    "argparse type for shards given as i/N, such as 0/4 for the first of four"
+    try:
+        i, n = map(int, text.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'shard should be i/N, not {text}')
+    if not 0 <= i < n:
+        raise argparse.ArgumentTypeError(f'shard {i} is not between 0 and {n - 1}')
+    return shard(i, n)
+
+
+def every(*predicates):
+    "a predicate for parse_xml keeping records that all the given predicates keep"
+    predicates = tuple(p for p in predicates if p is not None)
+    if predicates:
+        return partial(all_of, predicates)
+
+
+class field_schema():
+    """The names of a record's fields in order, shared by every record with the
+    same fields, with the position of each field in a record's values and the
+    schemas of records with one more field"""
+    __slots__ = ('names', 'positions', 'extended')
+
+    def __init__(self, names):
+        self.names = names
+        self.positions = {name: i for i, name in enumerate(names)}
+        self.extended = {}
+
+    def extend(self, name):
+        "the schema of records with this schema's fields followed by name"
+        schema = self.extended.get(name)
+        if schema is None:
+            schema = self.extended[name] = get_schema(self.names + (name,))
+        return schema
+
+
+schemas = {}
+
+def get_schema(names):
+    "the shared schema for a tuple of field names"
+    schema = schemas.get(names)
+    if schema is None:
+        names = tuple(sys.intern(x) if type(x) is str else x for x in names)
+        schema = schemas[names] = field_schema(names)
+    return schema
+
+
+EMPTY_SCHEMA = get_schema(())
+common_values = {}
+
+def common_value(value):
+    "a shared copy of a short atom value, so values repeated across records are held once"
+    if value is None or len(value) > INTERN_LENGTH:
+        return value
+    shared = common_values.get(value)
+    if shared is None:
+        if len(common_values) >= INTERN_LIMIT:
+            return value
+        shared = common_values[value] = value
+    return shared
+
+
+class record_items(ItemsView):
+    __slots__ = ()
+
+    def __iter__(self):
+        return zip(self._mapping._schema.names, self._mapping._values)
+
+
+class record_values(ValuesView):
+    __slots__ = ()
+
+    def __iter__(self):
+        return iter(self._mapping._values)
+
+
+class record(MutableMapping):
+    """An EMu record, mapping field names to atom values, nested records (tuples)
+    and lists of nested records (tables). Rather than a dict per record, field
+    names are kept in a schema shared by all records with the same fields and
+    values in a list, with short atom values shared between records."""
+    __slots__ = ('_schema', '_values', 'source', '_field_index')
+
+    def __init__(self, *args, **kwargs):
+        self._schema = EMPTY_SCHEMA
+        self._values = []
+        # the serialised tuple a top level record was parsed from
+        self.source = None
+        self._field_index = None
+        if args or kwargs:
+            self.update(*args, **kwargs)
+
+    @classmethod
+    def from_fields(cls, names, values):
+        "a record of the given field names and list of values"
+        rec = cls()
+        schema = get_schema(tuple(names))
+        if len(schema.positions) == len(values):
+            rec._schema = schema
+            rec._values = values
+        else:
+            # a repeated name keeps its last value, as it would in a dict
+            rec.update(zip(names, values))
+        return rec
+
+    def __getitem__(self, key):
+        return self._values[self._schema.positions[key]]
+
+    def __setitem__(self, key, value):
+        # an edited record no longer matches the tuple it was parsed from
+        self.source = None
+        self._field_index = None
+        i = self._schema.positions.get(key)
+        if i is None:
+            self._schema = self._schema.extend(key)
+            self._values.append(value)
+        else:
+            self._values[i] = value
+
+    def __delitem__(self, key):
+        self.source = None
+        self._field_index = None
+        i = self._schema.positions[key]
+        names = self._schema.names
+        self._schema = get_schema(names[:i] + names[i + 1:])
+        del self._values[i]
+
+    def __iter__(self):
+        return iter(self._schema.names)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, key):
+        return key in self._schema.positions
+
+    def get(self, key, default=None):
+        i = self._schema.positions.get(key)
+        if i is None:
+            return default
+        return self._values[i]
+
+    def items(self):
+        return record_items(self)
+
+    def values(self):
+        return record_values(self)
 
-class record(dict):
     def __repr__(self):
-        return super(record, self).__repr__()
+        return repr(dict(self.items()))
+
+    def __reduce__(self):
+        """pickle records as their fields and source, so they can be handed
+        between processes without parsing them again"""
+        return new_record, (self.__class__,), self.__getstate__()
+
+    def __getstate__(self):
+        return self.source, self._schema.names, self._values
+
+    def __setstate__(self, state):
+        self.source, names, values = state
+        self._schema = get_schema(names)
+        self._values = list(values)
+
+    @classmethod
+    def from_source(cls, source, projection=None):
+        "Parse a record from the bytes of its tuple in an export, as parse_xml would"
+        tuple_elem = etree.fromstring(clean_text(source.decode('utf-8')))
+        rec = cls.parse_tuple(tuple_elem, projection)
+        rec.source = etree.tostring(tuple_elem, encoding='UTF-8', with_tail=False)
+        return rec
+
+    @classmethod
+    def load(cls, xml_doc, irn=None, unit_id=None, fields=None):
+        """Parse a single record from an export by irn or EADUnitID, reading only
+        its tuple through the export's offset index. Returns None if there's
+        no such record, or the first where several records share a unit id."""
+        if irn is not None:
+            found = cls.load_many(xml_doc, 'irn', [irn], fields)
+        elif unit_id is not None:
+            found = cls.load_many(xml_doc, 'EADUnitID', [unit_id], fields)
+        else:
+            raise ValueError('load needs an irn or unit_id')
+        return next(found, None)
+
+    @classmethod
+    def load_many(cls, xml_doc, field, values, fields=None):
+        """Parse the records in an export with any of the given values of an
+        indexed field (irn or EADUnitID), in export order, reading only their
+        tuples through the export's offset index (built beside the export the
+        first time it's used, see offset_index). Given fields, only those
+        fields are parsed, as in parse_xml."""
+        index = get_offset_index(xml_doc)
+        projection = None if fields is None else compile_fields(fields)
+        for start, length in index.find(field, values):
+            yield cls.from_source(index.read(start, length), projection)
+
+    @property
+    def xml(self):
+        "the record as an EMu xml tuple element, parsed from its source if it has one"
+        if self.source is not None:
+            return etree.fromstring(self.source)
+        return self.to_xml()
+
+    def to_source(self):
+        "the record's EMu xml tuple as bytes, reusing the source it was parsed from"
+        if self.source is not None:
+            return self.source
+        # indented as a tuple in a top level table
+        tuple_elem = self.to_xml()
+        etree.indent(tuple_elem, level=1)
+        return etree.tostring(tuple_elem, encoding='UTF-8')
 
     @classmethod
-    def parse_tuple(cls, tuple_elem):
-        "Parse out a record within an EMu xml report to JSON"
-        new_rec = cls()
-        new_rec.xml = tuple_elem
+    def parse_tuple(cls, tuple_elem, projection=None):
+        """Parse out a record within an EMu xml report to JSON. With a projection
+        (from compile_fields), fields outside it are skipped, as are nested
+        tuples and tables only matched by ** that are left with nothing in them."""
+        names, values = [], []
+        if projection is None:
+            for elem in tuple_elem:
+                if elem.tag == 'atom':
+                    names.append(elem.attrib['name'])
+                    values.append(common_value(elem.text))
+                elif elem.tag == 'tuple':
+                    names.append(elem.attrib['name'])
+                    values.append(cls.parse_tuple(elem))
+                elif elem.tag == 'table':
+                    names.append(elem.attrib['name'])
+                    values.append([cls.parse_tuple(record) for record in elem.iterfind('tuple')])
+            return cls.from_fields(names, values)
         for elem in tuple_elem:
+            name = elem.attrib.get('name')
+            inner = project(projection, name)
+            if inner is not None and not inner:
+                continue
             if elem.tag == 'atom':
-                new_rec[elem.attrib['name']] = elem.text
+                if inner is None:
+                    names.append(name)
+                    values.append(common_value(elem.text))
             elif elem.tag == 'tuple':
-                new_rec[elem.attrib['name']] = cls.parse_tuple(elem)
+                value = cls.parse_tuple(elem, inner)
+                if value or inner is None or named_in(inner):
+                    names.append(name)
+                    values.append(value)
             elif elem.tag == 'table':
-                new_rec[elem.attrib['name']] = []
-                for record in elem.iterfind('tuple'):
-                    new_rec[elem.attrib['name']].append(cls.parse_tuple(record))
-        return new_rec
+                rows = [cls.parse_tuple(record, inner) for record in elem.iterfind('tuple')]
+                if any(rows) or inner is None or named_in(inner):
+                    names.append(name)
+                    values.append(rows)
+        return cls.from_fields(names, values)
 
     @classmethod
-    def parse_xml(cls, xml_doc):
-        "iterator to generate JSON EMu records from xml"
-        with open(xml_doc, encoding='utf-8') as f:
-            text = f.read()
-            for x in range(8):
-                text = text.replace(chr(x), ' ')
-            text = text.replace(chr(19), '')
-            text = text.replace(chr(20), '')
-            text = text.replace(chr(24), '')
-            text = text.replace(chr(25), '')
-            text = text.replace(chr(28), '')
-            text = text.replace(chr(29), '')
-            text = text.replace('\u2014', '-')
-            text = text.replace('\u2013', '-')
-            text = text.replace('encoding="UTF-8"', '')
-        tree = etree.fromstring(text)
-        for elem in tree.iterfind('tuple'):
-            yield cls.parse_tuple(elem)
+    def parse_xml(cls, xml_doc, fields=None, where=None, workers=1, ordered=True):
+        """iterator to generate JSON EMu records from an export (or a list of them).
+        fields limits what's parsed (see compile_fields), where skips tuples before
+        they're parsed (see shard), and more than one worker parses in a pool of
+        processes, in export order unless ordered is False."""
+        if isinstance(xml_doc, (list, tuple)):
+            xml_docs = xml_doc
+        else:
+            xml_docs = [xml_doc]
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as ex:
+                parse = partial(cls.parse_ranges, ex, workers, ordered)
+                for doc in xml_docs:
+                    yield from cls.parse_export(doc, fields, where, parse, store=ordered)
+        else:
+            for doc in xml_docs:
+                yield from cls.parse_export(doc, fields, where, cls.stream_xml)
+
+    @classmethod
+    def parse_export(cls, xml_doc, fields, where, parse, store=True):
+        "parse an export with parse(xml_doc, projection, where), going through the parse cache"
+        projection = compile_fields(fields)
+        cache = get_parse_cache()
+        if cache is None:
+            yield from parse(xml_doc, projection, where)
+        else:
+            entry = cache.entry(xml_doc, fields)
+            # where reads the tuple before it's projected, so a projected parse
+            # can't be filtered once it's replayed from the cache
+            if entry.exists() and (fields is None or where is None):
+                for rec in cache.replay(entry, cls):
+                    if where is None or where(rec.atom):
+                        yield rec
+            elif where is not None or not store:
+                yield from parse(xml_doc, projection, where)
+            else:
+                yield from cache.store(entry, parse(xml_doc, projection))
+
+    @classmethod
+    def parse_ranges(cls, ex, workers, ordered, xml_doc, projection=None, where=None):
+        "parse an export split into byte ranges in the process pool ex"
+        range_size = min(RANGE_SIZE, max(Path(xml_doc).stat().st_size // (workers * 4), 1))
+        root, ranges = split_export(xml_doc, range_size)
+        pending = []
+        for start, end in ranges:
+            pending.append(ex.submit(parse_range, cls, xml_doc, root, start, end, projection, where))
+            while len(pending) >= workers * 2:
+                yield from finished_ranges(pending, ordered)
+        while pending:
+            yield from finished_ranges(pending, ordered)
+
+    @classmethod
+    def stream_xml(cls, xml_doc, projection=None, where=None):
+        parser = etree.XMLPullParser(events=('end',), tag='tuple')
+        for chunk in read_clean(xml_doc):
+            parser.feed(chunk)
+            yield from cls.parse_events(parser, projection, where)
+        parser.close()
+        yield from cls.parse_events(parser, projection, where)
+
+    @classmethod
+    def parse_events(cls, parser, projection=None, where=None):
+        """Parse any top level tuples the parser has finished, detaching them from
+        the tree so memory doesn't grow with the size of the report"""
+        for _, elem in parser.read_events():
+            table = elem.getparent()
+            if table is not None and table.getparent() is None:
+                rec = None
+                if where is None or where(partial(top_atom, elem)):
+                    rec = cls.parse_tuple(elem, projection)
+                    rec.source = etree.tostring(elem, encoding='UTF-8', with_tail=False)
+                table.remove(elem)
+                if rec is not None:
+                    yield rec
 
     def merge_field(self, **kwargs):
         """merge a given field based on kwargs - table fields are appended as
@@ -50,7 +631,7 @@ class record(dict):
         for key, val in kwargs.items():
             if key.endswith('_tab'):
                 if self.get(key) is not None:
-                    self[key].append(val)
+                    self[key] = self[key] + [val]
                 else:
                     self[key] = [val]
             else:
@@ -87,97 +668,388 @@ class record(dict):
         return root_element
 
     def flatten(self, parent_key='', sep='.'):
-        "Flatten the record JSON structure to a format suitable for CSV output"
-        items = []
+        """Flatten the record JSON structure to a format suitable for CSV output.
+        Repeated fields are joined with |, leaving out empty values before the
+        first value in each record"""
+        parts = {}
         for k, v in self.items():
             new_key = parent_key + sep + k if parent_key else k
             if isinstance(v, MutableMapping):
-                items.extend(v.flatten(new_key, sep=sep).items())
+                items = v.flatten(new_key, sep=sep).items()
             elif isinstance(v, list):
-                for x in v:
-                    items.extend(x.flatten(new_key, sep=sep).items())
+                items = (item for x in v for item in x.flatten(new_key, sep=sep).items())
             else:
-                items.append((new_key, v))
-        row = {}
-        for field, value in items:
-            if value is None:
-                value = ''
-            if not row.get(field):
-                row[field] = value
+                items = ((new_key, v),)
+            for field, value in items:
+                values = parts.setdefault(field, [])
+                if value:
+                    values.append(value)
+                elif values:
+                    values.append('')
+        return {field: '|'.join(values) for field, values in parts.items()}
+
+    def field_index(self):
+        """Index every atom, table and named tuple in the record (including nested
+        records) by name, built on first use in a single walk of the record"""
+        if getattr(self, '_field_index', None) is None:
+            self._field_index = ({}, {}, {})
+            self.index_fields(*self._field_index)
+        return self._field_index
+
+    def index_fields(self, atoms, tables, tuples):
+        "walk the record in document order, adding values to the given indexes"
+        for key, value in self.items():
+            if isinstance(value, list):
+                rows = tables.setdefault(key, [])
+                for row in value:
+                    if isinstance(row, record):
+                        rows.append(row)
+                        row.index_fields(atoms, tables, tuples)
+            elif isinstance(value, record):
+                tuples.setdefault(key, []).append(value)
+                value.index_fields(atoms, tables, tuples)
             else:
-                row[field] += '|' + value
-        return row
-    
+                atoms.setdefault(key, []).append(value)
+
+    def atom(self, fieldname):
+        "return the value of an atom directly within this record"
+        value = self.get(fieldname)
+        if not isinstance(value, (list, record)):
+            return value
+
     def findall(self, fieldname):
         "return all text values for a given fielldname, including in nested records"
-        xpath = f".//atom[@name='{fieldname}']"
-        for x in self.xml.findall(xpath):
-            if x.text is not None:
-                yield x.text
+        atoms, _, _ = self.field_index()
+        for x in atoms.get(fieldname, []):
+            if x is not None:
+                yield x
     
     def find(self, fieldname):
         "return the first value for a given fieldname, including in nested records"
-        xpath = f".//atom[@name='{fieldname}']"
-        x = self.xml.find(xpath)
-        if x is not None:
-            return x.text
+        atoms, _, _ = self.field_index()
+        values = atoms.get(fieldname)
+        if values:
+            return values[0]
 
     def find_in_table(self, table_name, fieldnames):
         "return the first value for a given fieldname, including in nested records"
-        xpath = f".//table[@name='{table_name}']/tuple"
-        for x in self.xml.findall(xpath):
-            data = {}
-            for f in fieldnames:
-                xpath = f"atom[@name='{f}']"
-                e = x.find(xpath)
-                if e is not None:
-                    data[f] = e.text
-                else:
-                    data[f] = None
-            yield data
+        _, tables, _ = self.field_index()
+        for x in tables.get(table_name, []):
+            yield {f: x.atom(f) for f in fieldnames}
 
 
     def find_in_tuple(self, tuple_name, fieldnames): 
         "return the first value for a given fieldname, including in nested records"
-        xpath = f".//tuple[@name='{tuple_name}']"
-        for x in self.xml.findall(xpath):
-            data = {}
-            for f in fieldnames:
-                xpath = f"atom[@name='{f}']"
-                e = x.find(xpath)
-                if e is not None:
-                    data[f] = e.text
-                else:
-                    data[f] = None
-            yield data
+        _, _, tuples = self.field_index()
+        for x in tuples.get(tuple_name, []):
+            yield {f: x.atom(f) for f in fieldnames}
 
     def print_xml(self):
         return etree.tostring(self.to_xml(), pretty_print=True).decode()
 
     @staticmethod
     def serialise_to_xml(table, records, out_file):
-        table_elem = etree.Element('table', name=table)
-        for rec in records:
-            table_elem.append(rec.to_xml())
-        tree = etree.ElementTree(table_elem)
-        tree.write(
-            str(out_file), pretty_print=True, standalone=True, xml_declaration=True,
-            encoding='UTF-8')
+        """Write records to an EMu xml file, copying each record's source tuple
+        into the table rather than rebuilding it"""
+        with open(out_file, 'wb') as f:
+            f.write(b"<?xml version='1.0' encoding='UTF-8' standalone='yes'?>\n")
+            f.write(f'<table name={quoteattr(table)}>\n'.encode('utf-8'))
+            for rec in records:
+                f.write(b'  ' + rec.to_source() + b'\n')
+            f.write(b'</table>\n')
 
     @classmethod
     def serialise_to_csv(cls, in_file, out_file):
-        fieldnames = set()
-        rows = []
-        for r in cls.parse_xml(in_file):
-            row = r.flatten()
-            fieldnames.update(row.keys())
-            rows.append(row)
-        fieldnames = list(fieldnames)
-        fieldnames.sort()
-        with open(out_file, 'w', encoding='utf-8-sig', newline='') as f:
-            writer= csv.DictWriter(f, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerows(rows)
+        """Flatten an EMu xml report to csv with a column for every field. Rows
+        are spooled to a temporary file beside out_file while the columns are
+        gathered, then written out, so memory doesn't grow with the report."""
+        columns = {}
+        with TemporaryFile(dir=Path(out_file).resolve().parent) as spool:
+            for r in cls.parse_xml(in_file):
+                row = [(columns.setdefault(field, len(columns)), value) for field, value in r.flatten().items()]
+                pickle.dump(row, spool, protocol=pickle.HIGHEST_PROTOCOL)
+            fieldnames = sorted(columns)
+            positions = [None] * len(columns)
+            for i, field in enumerate(fieldnames):
+                positions[columns[field]] = i
+            spool.seek(0)
+            with open(out_file, 'w', encoding='utf-8-sig', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(fieldnames)
+                while True:
+                    try:
+                        row = pickle.load(spool)
+                    except EOFError:
+                        break
+                    values = [''] * len(fieldnames)
+                    for column, value in row:
+                        values[positions[column]] = value
+                    writer.writerow(values)
+
+def new_record(record_class):
+    return record_class()
+
+
+class cache_pickler(pickle.Pickler):
+    "pickles records of any class as base records with their fields and source"
+    def reducer_override(self, obj):
+        if isinstance(obj, record):
+            return new_record, (record,), obj.__getstate__()
+        return NotImplemented
+
+
+class cache_unpickler(pickle.Unpickler):
+    "unpickles cached records as the record class doing the parsing"
+    def __init__(self, f, record_class):
+        super().__init__(f)
+        self.record_class = record_class
+
+    def find_class(self, module, name):
+        if name == 'record':
+            return self.record_class
+        return super().find_class(module, name)
+
+
+class parse_cache():
+    """An on-disk cache of parsed records, keyed on the size and a hash of the
+    export file, so running against the same export again replays pickled
+    records rather than parsing xml. Least recently used entries are removed
+    once the cache grows past max_size bytes."""
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size
+        self.hashes = Path(self.cache_dir, 'hashes.json')
+
+    def file_hash(self, xml_doc):
+        "hash the export, reusing the hash from a previous run if its size and mtime are unchanged"
+        xml_doc = Path(xml_doc).resolve()
+        stat = xml_doc.stat()
+        ident = [stat.st_size, stat.st_mtime_ns]
+        hashes = {}
+        if self.hashes.exists():
+            with self.hashes.open(encoding='utf-8') as f:
+                hashes = json.load(f)
+        known = hashes.get(str(xml_doc))
+        if known is not None and known[:2] == ident:
+            return known[2]
+        h = hashlib.sha1()
+        with open(xml_doc, 'rb') as f:
+            for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+                h.update(block)
+        hashes[str(xml_doc)] = ident + [h.hexdigest()]
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        with self.hashes.open('w', encoding='utf-8') as f:
+            json.dump(hashes, f)
+        return h.hexdigest()
+
+    def entry(self, xml_doc, fields=None):
+        size = Path(xml_doc).stat().st_size
+        name = f'{self.file_hash(xml_doc)}-{size}-v{PARSE_CACHE_VERSION}'
+        if fields is not None:
+            projection = '\n'.join(sorted(set(fields)))
+            name += '-' + hashlib.sha1(projection.encode('utf-8')).hexdigest()[:12]
+        return Path(self.cache_dir, name + '.pickle')
+
+    def replay(self, entry, record_class):
+        os.utime(entry)
+        with open(entry, 'rb') as f:
+            while True:
+                try:
+                    batch = cache_unpickler(f, record_class).load()
+                except EOFError:
+                    break
+                yield from batch
+
+    def store(self, entry, records, batch_size=1000):
+        "pass records through, pickling them to the cache entry once all have been read"
+        tmp = entry.with_name(f'{entry.name}.{os.getpid()}.tmp')
+        try:
+            with open(tmp, 'wb') as f:
+                batch = []
+                for rec in records:
+                    batch.append(rec)
+                    if len(batch) >= batch_size:
+                        cache_pickler(f, protocol=pickle.HIGHEST_PROTOCOL).dump(batch)
+                        batch = []
+                    yield rec
+                cache_pickler(f, protocol=pickle.HIGHEST_PROTOCOL).dump(batch)
+            os.replace(tmp, entry)
+        finally:
+            if tmp.exists():
+                tmp.unlink()
+        self.evict()
+
+    def evict(self):
+        "remove least recently used entries until the cache is under max_size"
+        entries = sorted(self.cache_dir.glob('*.pickle'), key=lambda f: f.stat().st_mtime)
+        size = sum(f.stat().st_size for f in entries)
+        for f in entries:
+            if size <= self.max_size:
+                break
+            size -= f.stat().st_size
+            f.unlink()
+
+    def clear(self):
+        for f in self.cache_dir.glob('*.pickle'):
+            f.unlink()
+        if self.hashes.exists():
+            self.hashes.unlink()
+
+
+parsed_cache = None
+
+def get_parse_cache():
+    "the parse cache in PARSE_CACHE, if one is set up"
+    global parsed_cache
+    if parsed_cache is None and PARSE_CACHE:
+        parsed_cache = parse_cache(PARSE_CACHE, PARSE_CACHE_SIZE)
+    return parsed_cache
+
+
+def export_source(export, version=None):
+    """the name, size and modification time of an export, which change when it's
+    exported again, and the version of the format of what's built from it"""
+    stat = Path(export).stat()
+    source = [Path(export).name, stat.st_size, stat.st_mtime_ns]
+    if version is not None:
+        source.append(version)
+    return json.dumps(source)
+
+
+def sidecar_source(db_file):
+    "the source a sidecar database was built from, or None if it's missing or unreadable"
+    if not Path(db_file).exists():
+        return None
+    db = sqlite3.connect(db_file)
+    try:
+        found = db.execute("SELECT value FROM meta WHERE key = 'source'").fetchone()
+    except sqlite3.DatabaseError:
+        return None
+    finally:
+        db.close()
+    return found[0] if found is not None else None
+
+
+def open_sidecar(db_file, source, build):
+    """Connect to a sqlite database built from an export (see export_source),
+    first building it with build(db) if it was built from another source. The
+    database is built under a temporary name and then moved into place, with
+    its source in the meta table."""
+    db_file = Path(db_file)
+    if sidecar_source(db_file) != source:
+        tmp = db_file.with_name(f'{db_file.name}.{uuid4()}.tmp')
+        db = sqlite3.connect(tmp)
+        try:
+            db.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+            build(db)
+            db.execute('INSERT INTO meta VALUES (?, ?)', ('source', source))
+            db.commit()
+            db.close()
+            os.replace(tmp, db_file)
+        finally:
+            db.close()
+            if tmp.exists():
+                tmp.unlink()
+    return sqlite3.connect(db_file)
+
+
+class offset_index():
+    """A sqlite index beside an export (or at index_file) of the byte offset and
+    length of every top level tuple, by the OFFSET_FIELDS atoms of its record,
+    so single records can be read from a memory map of the export and parsed
+    without streaming the rest."""
+    def __init__(self, xml_doc, index_file=None):
+        self.xml_doc = Path(xml_doc)
+        if index_file is None:
+            index_file = self.xml_doc.with_name(self.xml_doc.name + '.offsets.sqlite')
+        self.index_file = Path(index_file)
+        self.source = export_source(self.xml_doc)
+        self.db = open_sidecar(self.index_file, self.source, self.build)
+        self.file = open(self.xml_doc, 'rb')
+        self.map = b''
+        if self.xml_doc.stat().st_size:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def build(self, db):
+        db.execute(
+            f'CREATE TABLE tuples (seq INTEGER PRIMARY KEY, {", ".join(x + " TEXT" for x in OFFSET_FIELDS)}, '
+            'start INTEGER, length INTEGER)')
+        db.executemany(
+            f'INSERT INTO tuples ({", ".join(OFFSET_FIELDS)}, start, length) '
+            f'VALUES ({", ".join("?" * (len(OFFSET_FIELDS) + 2))})', self.scan())
+        for field in OFFSET_FIELDS:
+            db.execute(f'CREATE INDEX tuples_{field} ON tuples ({field})')
+
+    def scan(self):
+        "the OFFSET_FIELDS values, offset and length of each top level tuple in the export"
+        if self.xml_doc.stat().st_size == 0:
+            return
+        with open(self.xml_doc, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            offsets = top_level_offsets(mm)
+            try:
+                start = next(offsets, None)
+                for end in offsets:
+                    source = mm[start:end].rstrip()
+                    tuple_elem = etree.fromstring(clean_text(source.decode('utf-8')))
+                    yield (*(top_atom(tuple_elem, x) for x in OFFSET_FIELDS), start, len(source))
+                    start = end
+            finally:
+                offsets.close()
+
+    def find(self, field, values):
+        "the offset and length of the tuples with any of the values of an indexed field, in export order"
+        if field not in OFFSET_FIELDS:
+            raise ValueError(f'{field} is not in the offset index, only {", ".join(OFFSET_FIELDS)}')
+        values = list(values)
+        if len(values) == 1:
+            return self.db.execute(
+                f'SELECT start, length FROM tuples WHERE {field} = ? ORDER BY seq', values).fetchall()
+        self.db.execute('CREATE TEMP TABLE IF NOT EXISTS wanted (value TEXT PRIMARY KEY)')
+        try:
+            self.db.executemany('INSERT OR IGNORE INTO wanted VALUES (?)', ((x,) for x in values))
+            return self.db.execute(
+                f'SELECT start, length FROM tuples WHERE {field} IN (SELECT value FROM wanted) '
+                'ORDER BY seq').fetchall()
+        finally:
+            self.db.execute('DELETE FROM wanted')
+            self.db.commit()
+
+    def read(self, start, length):
+        return self.map[start:start + length]
+
+    def close(self):
+        self.db.close()
+        if self.map:
+            self.map.close()
+        self.file.close()
+
+
+offset_indexes = {}
+
+def get_offset_index(xml_doc):
+    "the offset index of an export, built or rebuilt where it's missing or out of date"
+    key = str(Path(xml_doc).resolve())
+    index = offset_indexes.get(key)
+    if index is not None and index.source != export_source(xml_doc):
+        index.close()
+        index = None
+    if index is None:
+        index = offset_indexes[key] = offset_index(xml_doc)
+    return index
+
 
 if __name__ == '__main__':
-    record.serialise_to_csv(sys.argv[1], sys.argv[2])
+    parser = argparse.ArgumentParser(
+        description='Flatten an EMu xml report to csv')
+    parser.add_argument(
+        'input', nargs='?', help='EMu xml report')
+    parser.add_argument(
+        'output', nargs='?', help='csv file to write')
+    parser.add_argument(
+        '--clear-cache', action='store_true',
+        help='remove all records from the parse cache')
+    args = parser.parse_args()
+    if args.clear_cache:
+        parse_cache(PARSE_CACHE or DEFAULT_PARSE_CACHE, PARSE_CACHE_SIZE).clear()
+    if args.input is not None:
+        record.serialise_to_csv(args.input, args.output)
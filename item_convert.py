@@ -5,12 +5,17 @@ import shutil
 from pathlib import Path
 import re
 from tempfile import TemporaryDirectory
+from functools import partial
+from collections import deque
 import logging
 import metadata_funcs
-from emu_xml_parser import record
+from emu_xml_parser import record, parse_shard
 import openpyxl
 from cat_mapper import ReCollect_report
 
+# bump when a change to the conversion should reconvert records in incremental runs
+CONVERTER_VERSION = '1'
+
 logging.basicConfig(
     format=f'%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
 formatter = logging.Formatter(
@@ -23,6 +28,8 @@ ch.setLevel(logging.INFO)
 logger.addHandler(ch)
 
 class item(record):
+    __slots__ = ()
+
     def guess_copyright(self):
         text = self.get('EADUseRestrictions')
         if text is not None:
@@ -102,22 +109,31 @@ class item(record):
         return template
 
 
+    def accession_lot(self):
+        "the irn of the item's accession lot, if it has one"
+        for x in self.find_in_tuple('AccAccessionLotRef', ['irn']):
+            if x['irn'] is not None:
+                return x['irn']
+
+    def accession_rows(self, acc_report):
+        "the accession report rows for the item's accession lot, or None if it has no lot"
+        lot_irn = self.accession_lot()
+        if lot_irn is not None:
+            return acc_report.retrieve_row("EMu Accession Lot IRN", lot_irn)
+
     def get_parent_records(self, acc_report):
 
         """Identify the item's accession (if it has one)"""
         data = {}
-        lot_irn = None
-        for x in self.find_in_tuple('AccAccessionLotRef', ['irn']):
-            if x['irn'] is not None:
-                lot_irn = x['irn']
-                break
+        lot_irn = self.accession_lot()
         if lot_irn is not None:
             rows = acc_report.retrieve_row("EMu Accession Lot IRN", lot_irn)
             data['Accession'] = '|'.join([r['Node Title'] for r in rows])
-        for x in self.find_in_tuple("AssParentObjectRef", ['EADUnitID', 'EADUnitTitle', 'EADLevelAttribute']):
+        for parent in metadata_funcs.hierarchy.parents(self):
+            x = {f: parent.atom(f) for f in ['EADUnitID', 'EADUnitTitle', 'EADLevelAttribute']}
             if x['EADLevelAttribute'] is not None:
                 level = x['EADLevelAttribute'].lower()
-                name = f"[{x['EADUnitID']}] {x['EADUnitTitle']}"
+                name = metadata_funcs.hierarchy.display_name(parent)
                 if level == 'series':
                     data['Series'] = name
                 elif level == 'item':
@@ -183,11 +199,11 @@ class item(record):
         prov = []
         contrib = []
         creator_roles = ["artist", "architect", "creator", "author", "director", "photographer", "producer"]
-        
+        photographic = 'photograph' in '|'.join(self.findall('EADGenreForm')).lower()
         for x in self.find_in_table('contributors', ['AssRelatedPartiesRelationship', 'NamCitedName']):
             role = x.get('AssRelatedPartiesRelationship')
             if role is None:
-                if 'photograph' in '|'.join(self.findall('EADGenreForm')).lower():
+                if photographic:
                     role = 'Photographer'
                 else:
                     role = ''
@@ -211,14 +227,12 @@ class item(record):
             string_date = 'Undated'
         date = metadata_funcs.format_date(string_date, self.get('EADUnitDateEarliest'), self.get('EADUnitDateLatest'))
         if string_date.lower() == 'undated':
-            for x in self.find_in_tuple('AssParentObjectRef', ['EADUnitDate', 'EADUnitDateEarliest', 'EADUnitDateLatest', 'EADLevelAttribute']):
-                d = metadata_funcs.format_date(x.get('EADUnitDate'), x.get('EADUnitDateEarliest'), x.get('EADUnitDateLatest'))
-                if d is not None:
-                    level = x.get('EADLevelAttribute')
-                    if level.lower() in ('acquisition', 'consolidation'):
-                        level = 'accession'
-                    date = "Undated;;#ng#" + d + "|Date of " + level
-                    break
+            inherited = metadata_funcs.hierarchy.parent_date(self)
+            if inherited is not None:
+                d, level = inherited
+                if level.lower() in ('acquisition', 'consolidation'):
+                    level = 'accession'
+                date = "Undated;;#ng#" + d + "|Date of " + level
         return date
 
     def get_title(self):
@@ -287,25 +301,90 @@ class item(record):
         return row
 
 
-def main(item_xml, accession_csv, out_dir, log_file=None, batch_id=None, logging=False):
+def convert_item(i, acc_report, out_dir, temp_dir):
+    """Convert an item to a row and template name, writing its EMu record to
+    temp_dir as an xml attachment"""
+    row = i.convert_to_row(acc_report, out_dir)
+    attach_record(i, row, temp_dir)
+    return i.identify_template().lower(), row
+
+
+def attach_record(i, row, temp_dir):
+    "write an item's EMu record to temp_dir as the row's xml attachment"
+    xml_path = Path(temp_dir, metadata_funcs.slugify(row['Identifier']) + '.xml')
+    record.serialise_to_xml('ecatalogue', [i], xml_path)
+    row['ATTACHMENTS'] = [xml_path]
+    return row
+
+
+worker_acc_report = None
+
+def init_worker(accession_csv):
+    global worker_acc_report
+    worker_acc_report = ReCollect_report(accession_csv, index_fields=['EMu Accession Lot IRN'])
+
+def convert_in_worker(i, out_dir, temp_dir):
+    return convert_item(i, worker_acc_report, out_dir, temp_dir)
+
+
+def main(item_xml, accession_csv, out_dir, log_file=None, batch_id=None, logging=False, workers=1, state_file=None, emit_unchanged=False, where=None):
+    """Convert an EMu item export to ReCollect sheets. With a state file, items
+    converted on a previous run are only converted again if their EMu record,
+    their rows in the accession report or CONVERTER_VERSION has changed;
+    unchanged items are left out of the sheets unless emit_unchanged is set,
+    in which case their stored rows are reused. where is a predicate for item.parse_xml choosing
+    which items to convert, such as a shard of the export."""
     if log_file is not None:
         audit_log = metadata_funcs.audit_log(log_file)
     templates = metadata_funcs.template_handler(batch_id=batch_id)
-    acc_report = ReCollect_report(accession_csv)
+    acc_report = ReCollect_report(accession_csv, index_fields=['EMu Accession Lot IRN'])
     metadata_funcs.configlogfile(Path(out_dir, templates.batch_id + '.log'), logger)
+    state = None
+    if state_file is not None:
+        state = metadata_funcs.conversion_state(state_file)
+        depends_on = state.fingerprint(CONVERTER_VERSION)
+    fingerprints = deque()
+    unchanged = 0
     with TemporaryDirectory(dir=out_dir) as t:
-        for i in item.parse_xml(item_xml):
-            row = i.convert_to_row(acc_report, out_dir)
-            xml_path = Path(t, metadata_funcs.slugify(row['Identifier']) + '.xml')
-            record.serialise_to_xml('ecatalogue', [i], xml_path)
-            row['ATTACHMENTS'] = [xml_path]
+        def add_row(template_name, row):
             if log_file is not None:
-                log = audit_log.get_record_log(r['irn'], t)
+                log = audit_log.get_record_log(row['EMu IRN'], t)
                 if log is not None:
                     row['ATTACHMENTS'].append(log)
-            template_name = i.identify_template().lower()
             templates.add_row(template_name, row)
-        templates.serialise(out_dir, sort_by='Identifier')
+
+        def changed_items():
+            nonlocal unchanged
+            for i in item.parse_xml(item_xml, where=where):
+                if state is not None:
+                    fingerprint = state.fingerprint(depends_on, i.to_source(), repr(i.accession_rows(acc_report)))
+                    stored = state.get(i['irn'], fingerprint)
+                    if stored is not None:
+                        unchanged += 1
+                        if emit_unchanged:
+                            template_name, row = stored
+                            add_row(template_name, attach_record(i, row, t))
+                        continue
+                    fingerprints.append((i['irn'], fingerprint))
+                yield i
+
+        if workers > 1:
+            converted = metadata_funcs.parallel_map(
+                partial(convert_in_worker, out_dir=out_dir, temp_dir=t),
+                changed_items(), workers,
+                initializer=init_worker, initargs=(accession_csv,))
+        else:
+            converted = (convert_item(i, acc_report, out_dir, t) for i in changed_items())
+        for template_name, row in converted:
+            if state is not None:
+                irn, fingerprint = fingerprints.popleft()
+                state.put(irn, fingerprint, template_name, row)
+            add_row(template_name, row)
+        templates.serialise(out_dir, sort_by='Identifier', workers=workers)
+    if state is not None:
+        state.commit()
+        state.close()
+        logger.info(f'{unchanged} items unchanged since the last run')
 
 
 if __name__ == '__main__':
@@ -323,7 +402,19 @@ if __name__ == '__main__':
     parser.add_argument(
         '--batch_id', '-b',
         help='name for batch (if not supplied, will use a uuid)')
+    parser.add_argument(
+        '--workers', '-w', type=int, default=1,
+        help='number of processes to convert records with')
+    parser.add_argument(
+        '--state', '-s',
+        help='state database for incremental runs; items unchanged since the last run are skipped')
+    parser.add_argument(
+        '--emit-unchanged', action='store_true',
+        help='with --state, include unchanged items in the sheets using their stored rows')
+    parser.add_argument(
+        '--shard', type=parse_shard,
+        help='convert only shard i of N of the export (by irn), given as i/N')
 
 
     args = parser.parse_args()
-    main(args.input_xml, args.accession_csv, args.output, log_file=args.audit, batch_id=args.batch_id, logging=True)
\ No newline at end of file
+    main(args.input_xml, args.accession_csv, args.output, log_file=args.audit, batch_id=args.batch_id, logging=True, workers=args.workers, state_file=args.state, emit_unchanged=args.emit_unchanged, where=args.shard)
\ No newline at end of file
@@ -0,0 +1,42 @@
+import argparse
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import multimedia_funcs
+
+
+def benchmark(tifs, engine, dim):
+    """Derive jpegs from each tif with an engine, bypassing the jpeg cache, and
+    return the number of images per second"""
+    derive = multimedia_funcs.JPEG_ENGINES[engine]
+    with TemporaryDirectory() as t:
+        start = time.perf_counter()
+        for tif in tifs:
+            derive(tif, Path(t, tif.stem + '.jpg'), dim)
+        elapsed = time.perf_counter() - start
+    return len(tifs) / elapsed
+
+
+def main(in_dir, engines, dim='2048x2048^>', limit=None):
+    tifs = list(multimedia_funcs.find_assets(in_dir))[:limit]
+    results = {}
+    for engine in engines:
+        results[engine] = benchmark(tifs, engine, dim)
+    for engine, rate in results.items():
+        print(f"{engine}: {rate:.2f} images/s over {len(tifs)} images")
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare jpeg derivative engines on a folder of tifs')
+    parser.add_argument(
+        'input', metavar='i', help='folder of tifs')
+    parser.add_argument(
+        '--engines', '-e', nargs='+', default=list(multimedia_funcs.JPEG_ENGINES),
+        help='engines to compare')
+    parser.add_argument(
+        '--dim', '-d', default='2048x2048^>', help='ImageMagick resize geometry')
+    parser.add_argument(
+        '--limit', '-l', type=int, help='maximum number of tifs to derive')
+    args = parser.parse_args()
+    main(args.input, args.engines, dim=args.dim, limit=args.limit)
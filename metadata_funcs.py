@@ -1,17 +1,39 @@
 import csv
+import os
 from pprint import pprint
 from pathlib import Path
 import shutil
 import re
 import calendar
+import hashlib
+import json
+import pickle
+import sqlite3
 from uuid import uuid4
 import logging
+import multiprocessing
 import unicodedata
+from collections import deque
+from collections.abc import Mapping
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from itertools import islice
 import multimedia_funcs
+from emu_xml_parser import export_source, open_sidecar
 import openpyxl
 from pypdf import PdfWriter, PdfReader
 
 TEMPLATE_DIR = Path(__file__).parent / "Templates"
+# assets copied (and jpegs derived) at once across a whole run, shared between
+# the processes writing workbooks; set RMS_COPY_WORKERS to suit the file share
+COPY_WORKERS = int(os.environ.get('RMS_COPY_WORKERS', 8))
+# rows a template keeps in memory before moving them to a temporary database
+# on disk; set RMS_SPILL_ROWS to 0 to keep all rows in memory
+SPILL_ROWS = int(os.environ.get('RMS_SPILL_ROWS', 200000))
+# tuples holding the parent records hierarchy_cache memoizes; other nested
+# records (multimedia, contributors) are unique to a record and aren't kept
+PARENT_TUPLES = ('AssParentObjectRef', 'AccAccessionLotRef')
 
 logger = logging.getLogger('__main__')
 
@@ -26,6 +48,39 @@ def configlogfile(logfile, logger):
     fh.setFormatter(formatter)
     logger.addHandler(fh)
 
+class worker_log_handler():
+    "hands log records from worker processes to the logger of the same name in this process"
+    def handle(self, record):
+        # a spawned worker imports the script being run as __mp_main__
+        name = '__main__' if record.name == '__mp_main__' else record.name
+        logging.getLogger(name).handle(record)
+
+@contextmanager
+def worker_logging():
+    """A queue for worker processes to send their log records to (see
+    init_worker_logging), so they're logged here by the handlers set up with
+    configlogfile rather than lost or written by several processes at once"""
+    from logging.handlers import QueueListener
+    queue = multiprocessing.Queue()
+    listener = QueueListener(queue, worker_log_handler())
+    listener.start()
+    try:
+        yield queue
+    finally:
+        listener.stop()
+
+def init_worker_logging(queue, level, initializer=None, initargs=()):
+    "set up a worker process to send its log records to queue, then run initializer"
+    from logging.handlers import QueueHandler
+    for existing in list(logging.root.manager.loggerDict.values()):
+        if isinstance(existing, logging.Logger):
+            existing.handlers = []
+            existing.propagate = True
+    logging.root.handlers = [QueueHandler(queue)]
+    logging.root.setLevel(level)
+    if initializer is not None:
+        initializer(*initargs)
+
 def slugify(value, allow_unicode=False):
     """
     Taken from https://github.com/django/django/blob/master/django/utils/text.py
@@ -79,13 +134,111 @@ def get_access(record):
     access_text = record.get('EADAccessRestrictions')
     access_status, access_conditions = find_access(access_text)
     if access_status == "Access not determined":
-        for x in record.findall('EADAccessRestrictions'):
-            access_status, _ = find_access(x)
-            if access_status != "Access not determined":
-                break
+        access_status = hierarchy.access_status(record)
     return access_status, access_conditions
 
 
+def nested_records(record):
+    "the records nested in a record in document order, with the name of the tuple or table holding them"
+    for key, value in record.items():
+        if isinstance(value, list):
+            for row in value:
+                if isinstance(row, Mapping):
+                    yield key, row
+        elif isinstance(value, Mapping):
+            yield key, value
+
+
+class hierarchy_cache():
+    """Values records inherit from the parent records nested in them, worked
+    out once per parent and reused for every other record with the same parent.
+    A parent (in PARENT_TUPLES) carries fewer of its own ancestors the deeper it's
+    nested, so parents are keyed on the tuple holding them and their content."""
+    def __init__(self):
+        self.access = {}
+        self.dates = {}
+        self.parent_records = {}
+        self.names = {}
+
+    def memoized(self, memo, key, parent, func):
+        if parent.get('irn') is None or key not in PARENT_TUPLES:
+            return func(parent)
+        memo_key = (key, row_digest(parent))
+        if memo_key not in memo:
+            memo[memo_key] = func(parent)
+        return memo[memo_key]
+
+    def access_status(self, record):
+        """the first access status found in EADAccessRestrictions in a record and
+        the records nested in it, in document order"""
+        for key, value in record.items():
+            if isinstance(value, (list, Mapping)):
+                parents = value if isinstance(value, list) else [value]
+                for parent in filter(lambda x: isinstance(x, Mapping), parents):
+                    status = self.memoized(self.access, key, parent, self.access_status)
+                    if status != "Access not determined":
+                        return status
+            elif key == 'EADAccessRestrictions':
+                status, _ = find_access(value)
+                if status != "Access not determined":
+                    return status
+        return "Access not determined"
+
+    def parent_date(self, record):
+        """the formatted date and level of the first parent (in AssParentObjectRef)
+        with a date, searching the parents nested in a record in document order"""
+        for key, parent in nested_records(record):
+            found = self.memoized(self.dates, key, parent, partial(self.tuple_date, key))
+            if found is not None:
+                return found
+
+    def tuple_date(self, key, parent):
+        if key == 'AssParentObjectRef':
+            date = format_date(parent.get('EADUnitDate'), parent.get('EADUnitDateEarliest'), parent.get('EADUnitDateLatest'))
+            if date is not None:
+                return date, parent.get('EADLevelAttribute')
+        return self.parent_date(parent)
+
+    def parents(self, record):
+        "the parent records (in AssParentObjectRef) nested in a record, in document order"
+        found = []
+        for key, parent in nested_records(record):
+            if key == 'AssParentObjectRef':
+                found.append(parent)
+            found.extend(self.memoized(self.parent_records, key, parent, self.parents))
+        return found
+
+    def display_name(self, parent):
+        "a parent's name as it's shown in ReCollect, [EADUnitID] EADUnitTitle"
+        return self.memoized(
+            self.names, 'AssParentObjectRef', parent,
+            lambda p: f"[{p.get('EADUnitID')}] {p.get('EADUnitTitle')}")
+
+
+hierarchy = hierarchy_cache()
+
+
+def map_chunk(func, chunk):
+    return [func(x) for x in chunk]
+
+def parallel_map(func, iterable, workers, chunksize=64, initializer=None, initargs=()):
+    """Map func over iterable in a pool of worker processes, yielding results in
+    the same order as the input. Items are sent to workers in chunks, and only a
+    few chunks per worker are in flight at once so the input can be a stream."""
+    iterable = iter(iterable)
+    pending = deque()
+    with worker_logging() as log_queue, ProcessPoolExecutor(
+            max_workers=workers, initializer=init_worker_logging,
+            initargs=(log_queue, logger.getEffectiveLevel(), initializer, initargs)) as ex:
+        while True:
+            chunk = list(islice(iterable, chunksize))
+            if chunk:
+                pending.append(ex.submit(map_chunk, func, chunk))
+            if pending and (len(pending) >= workers * 2 or not chunk):
+                yield from pending.popleft().result()
+            elif not chunk:
+                break
+
 def shorten_title(text):
     """Shorten title to 140 characters"""
     if len(str(text)) > 256:
@@ -185,20 +338,37 @@ def get_multimedia(record):
         return assets 
 
 
+def claim_target(asset_dir, name):
+    """Reserve a file name in asset_dir by creating it empty, prefixing a uuid
+    if the name is already taken. Creating the file is atomic, so rows can copy
+    assets into the same folder from several threads at once."""
+    target = Path(asset_dir, name)
+    try:
+        target.open('xb').close()
+    except FileExistsError:
+        target = Path(asset_dir, str(uuid4()) + '-' + name)
+        target.open('xb').close()
+    return target
+
+
 class Row(dict):
     def copy_assets(self, asset_dir, column):
         if self.get(column) is not None:
             assets = []
             for fpath in self[column]:
-                if fpath.suffix in ('.tif', '.tiff'):
-                    fpath = multimedia_funcs.create_jpeg(fpath, asset_dir)
-                target = Path(asset_dir, fpath.name)
-                if target.exists():
-                    target = Path(asset_dir, str(uuid4()) + '-' + fpath.name)
+                tif = fpath.suffix in ('.tif', '.tiff')
+                # tifs are derived straight into a claimed name, so rows with
+                # tifs of the same name don't write the same jpeg at once
+                target = claim_target(asset_dir, fpath.stem + '.jpg' if tif else fpath.name)
                 try:
-                    shutil.copy2(fpath, target)
+                    if tif:
+                        if not multimedia_funcs.derive_jpeg(fpath, target):
+                            raise OSError("Couldn't derive a jpeg from " + str(fpath))
+                    else:
+                        shutil.copy2(fpath, target)
                     assets.append(target.relative_to(asset_dir.parent).as_posix())
                 except Exception as e:
+                    target.unlink(missing_ok=True)
                     logger.error("Multimedia file " + str(fpath) + " for record " + self['Identifier']  + "couldn't be found")
             self[column] = '|'.join(assets)
 
@@ -244,31 +414,215 @@ class Row(dict):
         return sheet_row
 
 
-class audit_log(dict):
-    def __init__(self, csv_file):
-        with open(csv_file, encoding='utf_16_le') as f:
+class audit_log():
+    """An EMu audit log export, indexed by AudKey in a sqlite database beside
+    the export (or at index_file) so a record's log can be fetched without
+    holding the export in memory."""
+    def __init__(self, csv_file, index_file=None):
+        self.csv_file = Path(csv_file)
+        if index_file is None:
+            index_file = self.csv_file.with_name(self.csv_file.name + '.sqlite')
+        self.index_file = Path(index_file)
+        self.source = export_source(self.csv_file)
+        self.db = open_sidecar(self.index_file, self.source, self.build)
+        self.fieldnames = json.loads(self.db.execute(
+            "SELECT value FROM meta WHERE key = 'fieldnames'").fetchone()[0])
+
+    def build(self, db):
+        logger.info('Indexing audit log ' + self.csv_file.name)
+        db.execute('CREATE TABLE log (audkey TEXT, seq INTEGER PRIMARY KEY, row TEXT)')
+        with open(self.csv_file, encoding='utf_16_le') as f:
             reader = csv.DictReader(f)
-            self.fieldnames = reader.fieldnames
-            for row in reader:
-                if self.get(row['AudKey']) is None:
-                    self[row['AudKey']] = [row]
-                else:
-                    self[row['AudKey']].append(row)
+            fieldnames = reader.fieldnames
+            db.executemany(
+                'INSERT INTO log (audkey, row) VALUES (?, ?)',
+                ((row['AudKey'], json.dumps([row.get(x) for x in fieldnames])) for row in reader))
+        db.execute('CREATE INDEX log_audkey ON log (audkey)')
+        db.execute('INSERT INTO meta VALUES (?, ?)', ('fieldnames', json.dumps(fieldnames)))
 
     def get_record_log(self, irn, outdir):
         outfile = Path(outdir, irn + '.csv')
-        rows = self.get(irn)
-        if rows is not None:
+        rows = self.db.execute('SELECT row FROM log WHERE audkey = ? ORDER BY seq', (irn,)).fetchall()
+        if rows:
             with open(outfile, 'w', encoding='utf-8', newline='') as f:
-                writer = csv.DictWriter(f, fieldnames=self.fieldnames)
-                writer.writeheader()
-                writer.writerows(rows)                
+                writer = csv.writer(f)
+                writer.writerow(self.fieldnames)
+                writer.writerows(json.loads(row) for (row,) in rows)
             return outfile
 
+
+class conversion_state():
+    """What each record was converted to on previous runs, kept in a sqlite
+    database by irn along with a fingerprint of everything the conversion
+    depended on. Records whose fingerprint is unchanged can reuse their stored
+    row instead of being converted again. Changes are saved only on commit, so
+    a run that fails part way leaves the state as it was."""
+    def __init__(self, db_file):
+        self.db = sqlite3.connect(db_file)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS records '
+            '(irn TEXT PRIMARY KEY, fingerprint TEXT, template TEXT, row BLOB)')
+
+    @staticmethod
+    def fingerprint(*parts):
+        "hash strings or bytes (such as a record's source xml) into one fingerprint"
+        h = hashlib.sha1()
+        for part in parts:
+            if isinstance(part, str):
+                part = part.encode('utf-8')
+            h.update(hashlib.sha1(part).digest())
+        return h.hexdigest()
+
+    def get(self, irn, fingerprint):
+        "the template name and row a record was converted to, if its fingerprint is unchanged"
+        found = self.db.execute(
+            'SELECT template, row FROM records WHERE irn = ? AND fingerprint = ?',
+            (irn, fingerprint)).fetchone()
+        if found is not None:
+            return found[0], pickle.loads(found[1])
+
+    def put(self, irn, fingerprint, template_name, row):
+        self.db.execute(
+            'INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?)',
+            (irn, fingerprint, template_name, pickle.dumps(row)))
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+def row_digest(row):
+    """A stable digest of a row's values in order, so duplicate rows can be found
+    by hash rather than by comparing whole rows"""
+    return hashlib.sha1(repr(list(row.items())).encode('utf-8')).digest()
+
+
+class row_store():
+    """The rows for a template in the order they were added, with digests to spot
+    duplicates and indexes on chosen fields (of the values rows had when added).
+    Past spill_rows rows, they move to a temporary sqlite database on disk."""
+    def __init__(self, index_fields=(), spill_rows=SPILL_ROWS):
+        self.rows = {}
+        self.digests = set()
+        self.indexes = {}
+        self.spill_rows = spill_rows
+        self.db = None
+        for field in index_fields:
+            self.add_index(field)
+
+    def __len__(self):
+        if self.db is not None:
+            return self.db.execute('SELECT count(*) FROM rows').fetchone()[0]
+        return len(self.rows)
+
+    def __iter__(self):
+        if self.db is None:
+            return iter(list(self.rows.values()))
+        return self.iter_spilled()
+
+    def __contains__(self, row):
+        if self.db is not None:
+            found = self.db.execute(
+                'SELECT 1 FROM rows WHERE digest = ? LIMIT 1', (row_digest(row),))
+            return found.fetchone() is not None
+        return row_digest(row) in self.digests
+
+    def spill(self):
+        "move the rows to a temporary database, which sqlite deletes once closed"
+        self.db = sqlite3.connect('')
+        self.db.execute('CREATE TABLE rows (seq INTEGER PRIMARY KEY, digest BLOB, row BLOB)')
+        self.db.execute('CREATE INDEX rows_digest ON rows (digest)')
+        rows, self.rows, self.digests = self.rows, None, None
+        index_fields, self.indexes = self.indexes, {}
+        for field in index_fields:
+            self.add_index(field)
+        for row in rows.values():
+            self.append(row)
+
+    def iter_spilled(self, batch_size=1000):
+        seq = 0
+        while True:
+            batch = self.db.execute(
+                'SELECT seq, row FROM rows WHERE seq > ? ORDER BY seq LIMIT ?',
+                (seq, batch_size)).fetchall()
+            if not batch:
+                break
+            seq = batch[-1][0]
+            for _, row in batch:
+                yield pickle.loads(row)
+
+    def sorted_by(self, field):
+        "the rows in order of the string value of field, in the order added where equal"
+        if self.db is None:
+            return sorted(self, key=lambda row: str(row[field]))
+        self.db.create_function(
+            'sort_key', 1, lambda row: str(pickle.loads(row)[field]), deterministic=True)
+        return (pickle.loads(row) for (row,) in self.db.execute(
+            'SELECT row FROM rows ORDER BY sort_key(row), seq'))
+
+    def add_index(self, field):
+        if field in self.indexes:
+            return
+        if self.db is not None:
+            # spilled indexes are the name of the column holding the field
+            column = f'i{len(self.indexes)}'
+            self.db.execute(f'ALTER TABLE rows ADD COLUMN {column}')
+            self.db.execute(f'CREATE INDEX rows_{column} ON rows ({column})')
+            for seq, row in self.db.execute('SELECT seq, row FROM rows').fetchall():
+                self.db.execute(
+                    f'UPDATE rows SET {column} = ? WHERE seq = ?',
+                    (pickle.loads(row).get(field), seq))
+            self.indexes[field] = column
+        else:
+            self.indexes[field] = {}
+            for row in self.rows.values():
+                self.indexes[field].setdefault(row.get(field), {})[id(row)] = row
+
+    def lookup(self, field, value):
+        "return the rows with a value in an indexed field"
+        if self.db is not None:
+            found = self.db.execute(
+                f'SELECT row FROM rows WHERE {self.indexes[field]} IS ? ORDER BY seq', (value,))
+            return [pickle.loads(row) for (row,) in found]
+        return list(self.indexes[field].get(value, {}).values())
+
+    def append(self, row):
+        if self.db is not None:
+            columns = ['digest', 'row', *self.indexes.values()]
+            self.db.execute(
+                f'INSERT INTO rows ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})',
+                (row_digest(row), pickle.dumps(row), *(row.get(field) for field in self.indexes)))
+            return
+        self.rows[id(row)] = row
+        self.digests.add(row_digest(row))
+        for field, index in self.indexes.items():
+            index.setdefault(row.get(field), {})[id(row)] = row
+        if self.spill_rows and len(self.rows) > self.spill_rows:
+            self.spill()
+
+    def remove(self, row):
+        if self.db is not None:
+            self.db.execute(
+                'DELETE FROM rows WHERE seq = (SELECT seq FROM rows WHERE digest = ? ORDER BY seq LIMIT 1)',
+                (row_digest(row),))
+            return
+        del self.rows[id(row)]
+        self.digests.discard(row_digest(row))
+        for field, index in self.indexes.items():
+            entries = index[row.get(field)]
+            del entries[id(row)]
+            if not entries:
+                del index[row.get(field)]
+
+
 class template_handler(dict):
-    def __init__(self, batch_id=None):
+    def __init__(self, batch_id=None, spill_rows=SPILL_ROWS):
         super().__init__()
         self.fieldnames = {}
+        self.index_fields = {}
+        self.spill_rows = spill_rows
         if batch_id is None:
             self.batch_id = str(uuid4())
         else:
@@ -283,7 +637,7 @@ class template_handler(dict):
                         template_name = ident + '-' + template_name
                     logger.info('Adding template ' + template_name)
                     reader = csv.DictReader(f)
-                    self[template_name] = []
+                    self[template_name] = row_store(self.index_fields.get(template_name, ()), self.spill_rows)
                     self.fieldnames[template_name] = reader.fieldnames
                 break
 
@@ -301,42 +655,87 @@ class template_handler(dict):
         else:
             logger.info(ordered_row['NODE_TITLE'] + ' is already in template ' + batch_name)
 
+    def add_index(self, template_name, field):
+        """index a template's rows on a field, so pop_rows can find rows by its
+        value without checking every row"""
+        template_name = template_name.lower()
+        self.index_fields.setdefault(template_name, []).append(field)
+        if template_name in self.keys():
+            self[template_name].add_index(field)
+
     def pop_rows(self, template_name, params):
         """pops any rows matching params"""
-        matches = []
-        for row in self[template_name]:
-            match = True
-            for k, v in params.items():
-                if row.get(k) != v:
-                    match = False
-            if match:
-                matches.append(row)
-                self[template_name].remove(row)
+        rows = self[template_name]
+        indexed = [k for k in params.keys() if k in rows.indexes]
+        if indexed:
+            candidates = rows.lookup(indexed[0], params[indexed[0]])
+        else:
+            candidates = rows
+        matches = [row for row in candidates if all(row.get(k) == v for k, v in params.items())]
+        for row in matches:
+            rows.remove(row)
         return matches
 
     def chunk_rows(self, rows, rowlimit, sort_by):
         if sort_by is not None:
-            rows = sorted(rows, key=lambda row: str(row[sort_by]))
-        for i in range(0, len(rows), rowlimit):
-            yield rows[i:i + rowlimit]
-
-    def serialise(self, out_dir, rowlimit=3000, sort_by=None):
+            rows = rows.sorted_by(sort_by)
+        rows = iter(rows)
+        chunk = list(islice(rows, rowlimit))
+        while chunk:
+            yield chunk
+            chunk = list(islice(rows, rowlimit))
+
+    def chunk_jobs(self, out_dir, rowlimit, sort_by):
+        "yield the arguments for write_chunk for each chunk of each template"
         for template, rows in self.items():
             logger.info(f"{template}: {len(rows)}")
             for c, chunk in enumerate(self.chunk_rows(rows, rowlimit, sort_by), 1):
                 batch_name = f'{self.batch_id}_{template}_{c}'
                 logger.info(f"{batch_name}: {len(chunk)} rows")
                 asset_dir = Path(out_dir, batch_name)
-                asset_dir.mkdir(exist_ok=True)
-                wb = openpyxl.Workbook()
-                sheet = wb.active
-                sheet.append(self.fieldnames[template])
-                for row in chunk:
-                    try:
-                        sheet.append(row.normalise(asset_dir))
-                    except ValueError as e:
-                        logger.error(e)
-                        print(row)
                 fpath = Path(out_dir, f'{batch_name}.xlsx')
-                wb.save(fpath)
-
+                yield self.fieldnames[template], chunk, asset_dir, fpath
+
+    def serialise(self, out_dir, rowlimit=3000, sort_by=None, workers=1):
+        """Write each template out to workbooks of rowlimit rows, copying assets
+        to a folder per workbook. With more than one worker, workbooks are
+        written in parallel by a pool of processes."""
+        jobs = self.chunk_jobs(out_dir, rowlimit, sort_by)
+        if workers > 1:
+            pending = deque()
+            with worker_logging() as log_queue, ProcessPoolExecutor(
+                    max_workers=workers, initializer=init_worker_logging,
+                    initargs=(log_queue, logger.getEffectiveLevel())) as ex:
+                for job in jobs:
+                    pending.append(ex.submit(write_chunk, *job, copy_workers=max(1, COPY_WORKERS // workers)))
+                    if len(pending) >= workers * 2:
+                        pending.popleft().result()
+                for future in pending:
+                    future.result()
+        else:
+            for job in jobs:
+                write_chunk(*job)
+
+
+def write_chunk(fieldnames, chunk, asset_dir, fpath, copy_workers=COPY_WORKERS):
+    """Normalise a chunk of rows, copying their assets to asset_dir, and stream
+    them into a new write-only workbook at fpath. Rows are normalised by a pool
+    of threads so copies from the file share overlap, then written in order."""
+    asset_dir.mkdir(exist_ok=True)
+    wb = openpyxl.Workbook(write_only=True)
+    sheet = wb.create_sheet()
+    sheet.append(fieldnames)
+    with ThreadPoolExecutor(max_workers=copy_workers) as ex:
+        for sheet_row in ex.map(partial(normalise_row, asset_dir=asset_dir), chunk):
+            if sheet_row is not None:
+                sheet.append(sheet_row)
+    wb.save(fpath)
+    return fpath
+
+
+def normalise_row(row, asset_dir):
+    try:
+        return row.normalise(asset_dir)
+    except ValueError as e:
+        logger.error(e)
+        print(row)
@@ -1,9 +1,40 @@
 from pathlib import Path
+import argparse
+import json
 import os
+import posixpath
 import re
 import shutil
 import subprocess
+import hashlib
+import io
+import logging
+import threading
+from uuid import uuid4
 from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageCms, ImageFilter
+
+# root of the registered digitised holdings; set RMS_ASSET_ROOT to use a local copy
+ASSET_ROOT = os.environ.get(
+    'RMS_ASSET_ROOT',
+    r"\\research-cifs.unimelb.edu.au\9730-UniversityArchive-Shared\Digitised_Holdings\Registered")
+# asset manifest json (built by running this module) to look assets up in
+# instead of walking the share
+ASSET_MANIFEST = os.environ.get('RMS_ASSET_MANIFEST')
+JPEG_QUALITY = '65'
+JPEG_UNSHARP = '1.5x1+0.7+0.02'
+# 'magick' runs ImageMagick for each jpeg, 'pillow' derives them in process
+JPEG_ENGINE = os.environ.get('RMS_JPEG_ENGINE', 'magick')
+# derived jpegs are cached here and reused across batches; set to an empty
+# string to turn the cache off
+JPEG_CACHE = os.environ.get('RMS_JPEG_CACHE', Path.home() / '.cache' / 'rms' / 'jpegs')
+JPEG_CACHE_SIZE = int(os.environ.get('RMS_JPEG_CACHE_SIZE', 50 * 1024 ** 3))
+# scans are far bigger than Pillow's decompression bomb limit (as in multimedia_replacer)
+Image.MAX_IMAGE_PIXELS = 933120000
+# the icc profile colour space matching each mode pillow_jpeg writes
+PROFILE_SPACES = {'RGB': 'RGB', 'L': 'GRAY'}
+
+logger = logging.getLogger('__main__')
 
 def id_transform(number):
     idents = re.findall(r'(\d{4})[,_.-](\d{2,4})[,_.-](\d{1,5})', number)
@@ -32,19 +63,160 @@ def move_image(fpath, base_dir, ident):
     return new_dest
 
 
-def create_jpeg(fpath, outdir, dim='2048x2048^>'):
+class derivative_cache():
+    """A folder of derived files keyed on the identity of their source file (its
+    name, size and modification time) and the parameters used to derive them.
+    Entries are evicted least recently used first once the folder grows past
+    max_size bytes."""
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size
+        self.size = None
+        self.lock = threading.Lock()
+
+    def entry(self, fpath, suffix, *params):
+        stat = fpath.stat()
+        ident = '|'.join([fpath.name, str(stat.st_size), str(stat.st_mtime_ns), *params])
+        key = hashlib.sha1(ident.encode('utf-8')).hexdigest()
+        return Path(self.cache_dir, key[:2], key + suffix)
+
+    def fetch(self, entry, outfile):
+        "copy a cached file to outfile, returning False if it isn't cached"
+        try:
+            os.utime(entry)
+            shutil.copyfile(entry, outfile)
+            return True
+        except OSError:
+            return False
+
+    def store(self, entry, outfile):
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        tmp = entry.with_name(f'{entry.name}.{uuid4()}.tmp')
+        shutil.copyfile(outfile, tmp)
+        os.replace(tmp, entry)
+        with self.lock:
+            if self.size is None:
+                self.size = sum(f.stat().st_size for f in self.cache_dir.glob('*/*'))
+            else:
+                self.size += entry.stat().st_size
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        "remove least recently used entries until the cache is 90% of max_size"
+        entries = []
+        for f in self.cache_dir.glob('*/*'):
+            stat = f.stat()
+            entries.append((stat.st_mtime, stat.st_size, f))
+        entries.sort()
+        self.size = sum(e[1] for e in entries)
+        for _, size, f in entries:
+            if self.size <= self.max_size * 0.9:
+                break
+            try:
+                f.unlink()
+                self.size -= size
+            except OSError:
+                pass
+
+
+if JPEG_CACHE:
+    jpeg_cache = derivative_cache(JPEG_CACHE, JPEG_CACHE_SIZE)
+else:
+    jpeg_cache = None
+
+
+def create_jpeg(fpath, outdir, dim='2048x2048^>', engine=None):
+    """Derive a jpeg of the same name as an image in outdir (see derive_jpeg).
+    With no jpeg cache, an existing jpeg of the same name is kept."""
     fpath = Path(fpath)
     outfile = Path(outdir, fpath.stem+'.jpg')
-    if not outfile.exists():
-        print("jpegging", fpath.name, "->", outfile.name)
-        subprocess.run(
-            [
-                'magick', 'convert', str(fpath), '-resize', dim,
-                '-quality', '65', '-depth', '8', '-unsharp',
-                '1.5x1+0.7+0.02', str(outfile)])
+    if jpeg_cache is not None or not outfile.exists():
+        derive_jpeg(fpath, outfile, dim, engine)
     return outfile
 
 
+def derive_jpeg(fpath, outfile, dim='2048x2048^>', engine=None):
+    """Derive a jpeg from an image at outfile with ImageMagick or Pillow (by
+    default the JPEG_ENGINE), reusing it from the jpeg cache where the same source
+    has been derived with the same settings. Returns False if no jpeg was made."""
+    fpath = Path(fpath)
+    engine = engine or JPEG_ENGINE
+    if jpeg_cache is not None:
+        entry = jpeg_cache.entry(fpath, '.jpg', dim, JPEG_QUALITY, JPEG_UNSHARP, engine)
+        if jpeg_cache.fetch(entry, outfile):
+            return True
+    JPEG_ENGINES[engine](fpath, outfile, dim)
+    # outfile may be an empty placeholder (see metadata_funcs.claim_target)
+    if not outfile.exists() or outfile.stat().st_size == 0:
+        return False
+    if jpeg_cache is not None:
+        jpeg_cache.store(entry, outfile)
+    return True
+
+
+def magick_jpeg(fpath, outfile, dim):
+    print("jpegging", fpath.name, "->", outfile.name)
+    subprocess.run(
+        [
+            'magick', 'convert', str(fpath), '-resize', dim,
+            '-quality', JPEG_QUALITY, '-depth', '8', '-unsharp',
+            JPEG_UNSHARP, str(outfile)])
+
+
+def resize_geometry(size, dim):
+    """Work out the size an image of the given size is resized to by an
+    ImageMagick geometry string such as 2048x2048^>"""
+    w, h, flags = re.fullmatch(r'(\d*)(?:x(\d*))?([\^<>!]*)', str(dim)).groups()
+    width, height = size
+    if '!' in flags:
+        return int(w or width), int(h or height)
+    scales = [int(x) / y for x, y in ((w, width), (h, height)) if x]
+    if '^' in flags:
+        scale = max(scales)
+    else:
+        scale = min(scales)
+    if ('>' in flags and scale >= 1) or ('<' in flags and scale <= 1):
+        return size
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def pillow_jpeg(fpath, outfile, dim):
+    """Derive a jpeg in process with Pillow, matching the ImageMagick settings
+    used by magick_jpeg. Sources that support it (such as jpegs) are decoded at
+    reduced resolution, and large reductions are done with a fast box reduce
+    before resampling."""
+    print("jpegging", fpath.name, "->", outfile.name)
+    radius, sigma, amount, threshold = map(float, re.split(r'[x+]', JPEG_UNSHARP))
+    with Image.open(fpath) as im:
+        size = resize_geometry(im.size, dim)
+        icc_profile = im.info.get('icc_profile')
+        im.draft('RGB', size)
+        if im.mode in ('I;16', 'I;16B', 'I;16L', 'I'):
+            im = im.convert('I').point(lambda x: x * (1 / 256)).convert('L')
+        elif im.mode not in ('RGB', 'L'):
+            im = im.convert('RGB')
+        if im.size != size:
+            im = im.resize(size, Image.LANCZOS, reducing_gap=3.0)
+        im = im.filter(ImageFilter.UnsharpMask(
+            radius=sigma, percent=round(amount * 100), threshold=round(threshold * 255)))
+        if icc_profile is not None and profile_space(icc_profile) != PROFILE_SPACES[im.mode]:
+            # converted out of the profile's colour space (such as from CMYK)
+            icc_profile = None
+        im.save(outfile, 'JPEG', quality=int(JPEG_QUALITY), icc_profile=icc_profile)
+
+
+def profile_space(icc_profile):
+    "the colour space of an icc profile, such as RGB, GRAY or CMYK, or None if it can't be read"
+    try:
+        return ImageCms.ImageCmsProfile(io.BytesIO(icc_profile)).profile.xcolor_space.strip()
+    except (OSError, ImageCms.PyCMSError):
+        return None
+
+
+JPEG_ENGINES = {'magick': magick_jpeg, 'pillow': pillow_jpeg}
+
+
 def bulk_jpeg(in_dir, out_dir, lformat=False, exts=['.tif', '.tiff']):
     f = []
     with ThreadPoolExecutor() as ex:
@@ -58,17 +230,104 @@ def bulk_jpeg(in_dir, out_dir, lformat=False, exts=['.tif', '.tiff']):
     return results
 
 
+class asset_manifest():
+    """A saved listing of the asset tree, so asset folders can be found and
+    walked without going to the file share for every record. Refreshing only
+    re-lists directories whose modification time has changed."""
+    def __init__(self, manifest_file, root=ASSET_ROOT):
+        self.manifest_file = Path(manifest_file)
+        self.root = str(root)
+        self.dirs = {}
+        if self.manifest_file.exists():
+            with self.manifest_file.open(encoding='utf-8') as f:
+                data = json.load(f)
+            if data['root'] == self.root:
+                self.dirs = data['dirs']
+
+    def refresh(self):
+        dirs = {}
+        stack = ['']
+        while stack:
+            rel = stack.pop()
+            path = Path(self.root, rel)
+            try:
+                mtime = path.stat().st_mtime_ns
+            except OSError:
+                continue
+            entry = self.dirs.get(rel)
+            if entry is None or entry['mtime'] != mtime:
+                entry = {'mtime': mtime, 'dirs': [], 'files': []}
+                with os.scandir(path) as it:
+                    for e in it:
+                        if e.is_dir():
+                            entry['dirs'].append(e.name)
+                        else:
+                            entry['files'].append(e.name)
+            dirs[rel] = entry
+            stack.extend(posixpath.join(rel, d) for d in reversed(entry['dirs']))
+        self.dirs = dirs
+
+    def save(self):
+        tmp = self.manifest_file.with_name(self.manifest_file.name + '.tmp')
+        with tmp.open('w', encoding='utf-8') as f:
+            json.dump({'root': self.root, 'dirs': self.dirs}, f)
+        os.replace(tmp, self.manifest_file)
+
+    def relative(self, folder):
+        try:
+            rel = Path(folder).relative_to(self.root).as_posix()
+        except ValueError:
+            return None
+        if rel == '.':
+            rel = ''
+        if rel in self.dirs:
+            return rel
+
+    def find_folder(self, ident):
+        try:
+            pre, mid, suf = ident.split('.')
+        except ValueError:
+            return None
+        for rel in (Path(pre, mid, suf).as_posix(), Path(pre, mid, suf[1:]).as_posix()):
+            if rel in self.dirs:
+                return Path(self.root, rel)
+
+    def walk(self, folder):
+        "walk a folder in the manifest, in the same way as os.walk"
+        stack = [self.relative(folder)]
+        while stack:
+            rel = stack.pop()
+            entry = self.dirs.get(rel)
+            if entry is not None:
+                yield str(Path(self.root, rel)), entry['dirs'], entry['files']
+                stack.extend(posixpath.join(rel, d) for d in reversed(entry['dirs']))
+
+
+manifest = None
+
+def get_manifest():
+    "load the asset manifest named by ASSET_MANIFEST, if any"
+    global manifest
+    if manifest is None and ASSET_MANIFEST:
+        manifest = asset_manifest(ASSET_MANIFEST)
+    return manifest
+
+
 def find_asset_folder(ident):
-    base = r"\\research-cifs.unimelb.edu.au\9730-UniversityArchive-Shared\Digitised_Holdings\Registered"
+    if get_manifest() is not None:
+        folder = manifest.find_folder(ident)
+        if folder is not None:
+            return folder
+    base = ASSET_ROOT
     try:
         pre, mid, suf = ident.split('.')
         folder = Path(base, pre, mid, suf)
+        if not folder.exists():
+            folder = Path(base, pre, mid, suf[1:])
         if folder.exists():
+            if manifest is not None:
+                logger.warning('Asset folder ' + str(folder) + ' is missing from the manifest, which needs refreshing')
             return folder
-        else:
-            folder = Path(base, pre, mid, suf[1:])
-            if folder.exists():
-                return folder
     except ValueError as e:
         pass
 
@@ -76,8 +335,27 @@ def find_asset_folder(ident):
 def find_assets(folder, exts=('.tif', '.tiff')):
     if folder is None:
         return None
-    for root, _, files in os.walk(folder):
+    if get_manifest() is not None and manifest.relative(folder) is not None:
+        walk = manifest.walk(folder)
+    else:
+        walk = os.walk(folder)
+    for root, _, files in walk:
         for file in files:
             fpath = Path(root, file)
             if fpath.suffix.lower() in exts:
-                yield fpath
\ No newline at end of file
+                yield fpath
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Build or refresh a manifest of the digitised holdings asset tree')
+    parser.add_argument(
+        'manifest', help='manifest json file to create or refresh')
+    parser.add_argument(
+        '--root', '-r', default=ASSET_ROOT,
+        help='root of the asset tree (defaults to the Registered folder on the share)')
+    args = parser.parse_args()
+    m = asset_manifest(args.manifest, root=args.root)
+    m.refresh()
+    m.save()
+    print(f"{len(m.dirs)} folders in manifest of {m.root}")
@@ -0,0 +1,118 @@
+import argparse
+import random
+import time
+import tracemalloc
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from lxml import etree
+from emu_xml_parser import record
+
+LEVELS = ['Series', 'Sub-series', 'File', 'Item']
+ACCESS = ['Open', 'Closed', 'Restricted', 'Access not determined']
+WORDS = [
+    'letters', 'minutes', 'photographs', 'plans', 'reports', 'university', 'council',
+    'faculty', 'correspondence', 'students', 'building', 'records', 'committee', 'annual']
+
+
+def write_export(xml_doc, count, seed=0):
+    """Write a synthetic catalogue export of count records, each with the atoms,
+    tables and parent tuple the converters read"""
+    rand = random.Random(seed)
+    with open(xml_doc, 'w', encoding='utf-8') as f:
+        f.write("<?xml version='1.0' encoding='UTF-8' standalone='yes'?>\n")
+        f.write('<table name="ecatalogue">\n')
+        for irn in range(1, count + 1):
+            parent = irn // 50 + 1
+            year = 1900 + rand.randrange(120)
+            f.write(
+                '  <tuple>\n'
+                f'    <atom name="irn">{irn}</atom>\n'
+                f'    <atom name="EADLevelAttribute">{rand.choice(LEVELS)}</atom>\n'
+                f'    <atom name="EADUnitID">{year}.{parent:04}.{irn:05}</atom>\n'
+                f'    <atom name="EADUnitTitle">{" ".join(rand.choices(WORDS, k=6))}</atom>\n'
+                f'    <atom name="EADUnitDate">{year}</atom>\n'
+                f'    <atom name="EADUnitDateEarliest">{year}-01-01</atom>\n'
+                f'    <atom name="EADUnitDateLatest">{year}-12-31</atom>\n'
+                f'    <atom name="EADAccessRestrictions">{rand.choice(ACCESS)}</atom>\n'
+                f'    <atom name="AdmPublishWebNoPassword">{rand.choice(["Yes", "No"])}</atom>\n'
+                f'    <atom name="EADScopeAndContent">{" ".join(rand.choices(WORDS, k=30))}</atom>\n'
+                '    <table name="EADPreviousID_tab">\n'
+                f'      <tuple>\n        <atom name="EADPreviousID">{year}/{irn}</atom>\n      </tuple>\n'
+                f'      <tuple>\n        <atom name="EADPreviousID">UMA{irn}</atom>\n      </tuple>\n'
+                '    </table>\n'
+                '    <tuple name="AssParentObjectRef">\n'
+                f'      <atom name="irn">{parent}</atom>\n'
+                f'      <atom name="EADUnitID">{year}.{parent:04}</atom>\n'
+                f'      <atom name="EADLevelAttribute">Series</atom>\n'
+                f'      <atom name="EADUnitTitle">Series {parent}</atom>\n'
+                '    </tuple>\n'
+                '  </tuple>\n')
+        f.write('</table>\n')
+
+
+class dict_record(dict):
+    "a record held as a dict subclass, as records were before they were compact"
+
+
+def tuple_dict(tuple_elem):
+    rec = dict_record()
+    for elem in tuple_elem:
+        if elem.tag == 'atom':
+            rec[elem.attrib['name']] = elem.text
+        elif elem.tag == 'tuple':
+            rec[elem.attrib['name']] = tuple_dict(elem)
+        elif elem.tag == 'table':
+            rec[elem.attrib['name']] = [tuple_dict(x) for x in elem.iterfind('tuple')]
+    return rec
+
+
+def parse_dicts(xml_doc):
+    for _, elem in etree.iterparse(str(xml_doc), tag='tuple'):
+        table = elem.getparent()
+        if table.getparent() is None:
+            yield tuple_dict(elem)
+            table.remove(elem)
+
+
+def parse_records(xml_doc):
+    for rec in record.parse_xml(xml_doc):
+        rec.source = None
+        yield rec
+
+
+def measure(parse, xml_doc):
+    """Parse an export holding on to every record (without its source xml, which
+    is the same either way), returning the number of records, the memory they
+    take and the seconds taken to parse them"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    records = list(parse(xml_doc))
+    elapsed = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(records), size, elapsed
+
+
+def main(count, xml_doc=None):
+    with TemporaryDirectory() as t:
+        if xml_doc is None:
+            xml_doc = Path(t, 'ecatalogue.xml')
+            write_export(xml_doc, count)
+        results = {}
+        for name, parse in (('dict', parse_dicts), ('compact', parse_records)):
+            results[name] = measure(parse, xml_doc)
+    for name, (n, size, elapsed) in results.items():
+        print(f"{name}: {size / 1024 ** 2:.1f}MB, {size / n:.0f} bytes/record over {n} records, {elapsed:.1f}s")
+    print(f"compact records take {results['compact'][1] / results['dict'][1]:.0%} of the memory of dicts")
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare the memory taken by compact records and dicts on a synthetic export')
+    parser.add_argument(
+        '--records', '-n', type=int, default=500000,
+        help='number of records in the synthetic export')
+    parser.add_argument(
+        '--input', '-i', help='measure an existing export instead')
+    args = parser.parse_args()
+    main(args.records, xml_doc=args.input)
@@ -3,8 +3,9 @@ import re
 from pathlib import Path
 from pprint import pprint
 from tempfile import TemporaryDirectory
+from functools import partial
 import metadata_funcs
-from emu_xml_parser import record
+from emu_xml_parser import record, atom_equals, parse_shard, every
 
 
 def extract_linear_meterage(extent):
@@ -117,7 +118,7 @@ def find_accession(record):
     else:
         parent = record.get('AssParentObjectRef')
         if parent.get('EADUnitID') is not None:
-            accession = f"[{parent.get('EADUnitID')}] {parent.get('EADUnitTitle')}"
+            accession = metadata_funcs.hierarchy.display_name(parent)
     return accession
 
 
@@ -228,40 +229,63 @@ def update_accession(row, accession_data):
             row['Deposit Agreement'].append(agreement.get('MulTitle'))
 
 
-def main(catalogue_xml, accession_xml, out_dir, log_file=None):
+def convert_catalogue_record(r, temp_dir):
+    """Convert a series or accession record to a row and template name, writing
+    its EMu record to temp_dir as an xml attachment"""
+    row = convert_recordset(r)
+    xml_path = Path(temp_dir, metadata_funcs.slugify(r['EADUnitID']) + '.xml')
+    record.serialise_to_xml('ecatalogue', [r], xml_path)
+    row['ATTACHMENTS'].append(xml_path)
+    if r['EADLevelAttribute'].lower() in ('acquisition', 'consolidation'):
+        return 'accession', convert_accession(r, row)
+    else:
+        return 'series', row
+
+
+def main(catalogue_xml, accession_xml, out_dir, log_file=None, workers=1, where=None, indexed=False):
+    """Convert series and accession records to ReCollect sheets, adding
+    accession lot details to accessions. where is a predicate for
+    record.parse_xml choosing which catalogue records to convert; when given,
+    accession lots without a converted catalogue record are left out, as
+    their record may be in a part of the export that wasn't converted, and
+    with indexed only the lots converted records refer to are read, through
+    an offset index of the accession export."""
     if log_file is not None:
         audit_log = metadata_funcs.audit_log(log_file)
     templates = metadata_funcs.template_handler()
     templates.add_template('Accession')
     templates.add_template('Series')
+    templates.add_index('accession', 'EMu Accession Lot IRN')
     with TemporaryDirectory(dir=out_dir) as t:
-        for r in record.parse_xml(catalogue_xml):
-            row = convert_recordset(r)
-            xml_path = Path(t, metadata_funcs.slugify(r['EADUnitID']) + '.xml')
-            record.serialise_to_xml('ecatalogue', [r], xml_path)
-            row['ATTACHMENTS'].append(xml_path)
+        convert = partial(convert_catalogue_record, temp_dir=t)
+        if workers > 1:
+            converted = metadata_funcs.parallel_map(convert, record.parse_xml(catalogue_xml, where=where), workers)
+        else:
+            converted = map(convert, record.parse_xml(catalogue_xml, where=where))
+        for template_name, row in converted:
             if log_file is not None:
-                log = audit_log.get_record_log(r['irn'], t)
+                log = audit_log.get_record_log(row['EMu Catalogue IRN'], t)
                 if log is not None:
                     row['ATTACHMENTS'].append(log)
-            if r['EADLevelAttribute'].lower() in ('acquisition', 'consolidation'):
-                row = convert_accession(r, row)
-                templates.add_row('accession', row)
-            else:
-                templates.add_row('series', row)
-        for r in record.parse_xml(accession_xml):
+            templates.add_row(template_name, row)
+        if where is not None and indexed:
+            lots = {row.get('EMu Accession Lot IRN') for row in templates['accession']}
+            accessions = record.load_many(accession_xml, 'irn', lots - {None})
+        else:
+            accessions = record.parse_xml(accession_xml)
+        for r in accessions:
             rows = templates.pop_rows('accession', {'EMu Accession Lot IRN': r['irn']})
             if bool(rows):
                 for row in rows:
                     update_accession(row, r)
                     templates.add_row('accession', row)
-            else:
+            elif where is None:
                 row = create_accession(r)
                 xml_path = Path(t, metadata_funcs.slugify(row['NODE_TITLE']) + '.xml')
                 record.serialise_to_xml('ecatalogue', [r], xml_path)
                 row['ATTACHMENTS'] = [xml_path]
                 templates.add_row('accession', row)
-        templates.serialise(out_dir)
+        templates.serialise(out_dir, workers=workers)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -275,7 +299,24 @@ if __name__ == '__main__':
     parser.add_argument(
         '--audit', '-a',
         help='audit log export')
+    parser.add_argument(
+        '--workers', '-w', type=int, default=1,
+        help='number of processes to convert catalogue records with')
+    parser.add_argument(
+        '--level', '-l', nargs='+',
+        help='convert only records at these levels (EADLevelAttribute), such as series or acquisition')
+    parser.add_argument(
+        '--shard', type=parse_shard,
+        help='convert only shard i of N of the catalogue export (by irn), given as i/N')
+    parser.add_argument(
+        '--indexed', action='store_true',
+        help='with --level or --shard, read only the accession lots converted records refer to, '
+             'through an offset index of the accession export')
 
 
     args = parser.parse_args()
-    main(args.catalogue_xml, args.accesion_xml, args.output, log_file=args.audit)
\ No newline at end of file
+    level = None
+    if args.level is not None:
+        level = atom_equals('EADLevelAttribute', *args.level)
+    main(args.catalogue_xml, args.accesion_xml, args.output, log_file=args.audit, workers=args.workers,
+         where=every(level, args.shard), indexed=args.indexed)
\ No newline at end of file
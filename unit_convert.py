@@ -8,7 +8,7 @@ import re
 import logging
 from tempfile import TemporaryDirectory
 import metadata_funcs
-from emu_xml_parser import record
+from emu_xml_parser import record, parse_shard
 import openpyxl
 
 logging.basicConfig(
@@ -24,6 +24,7 @@ logger.addHandler(ch)
 
 
 class unit(record):
+    __slots__ = ()
 
     def convert_name(self):
         name = self.get('LocHolderName')
@@ -71,7 +72,7 @@ class unit(record):
                 if unit.get('EADUnitDate') is not None:
                     row['Date Range'] = metadata_funcs.format_date(unit.get('EADUnitDate'), unit.get('EADUnitDateEarliest'), unit.get('EADUnitDateLatest'))
                 parent = unit.get('AssParentObjectRef')
-                parent_name = f"[{parent.get('EADUnitID')}] {parent.get('EADUnitTitle')}"
+                parent_name = metadata_funcs.hierarchy.display_name(parent)
                 if parent.get('EADLevelAttribute') == 'Series':
                     row['Series'] = parent_name
                 else:
@@ -79,14 +80,14 @@ class unit(record):
         return row
 
 
-def main(holder_xml, out_dir, log_file=None):
+def main(holder_xml, out_dir, log_file=None, where=None):
     if log_file is not None:
         audit_log = metadata_funcs.audit_log(log_file)
     templates = metadata_funcs.template_handler()
     metadata_funcs.configlogfile(Path(out_dir, templates.batch_id + '.log'), logger)
     templates.add_template('unit')
     with TemporaryDirectory(dir=out_dir) as t:
-        for u in unit.parse_xml(holder_xml):
+        for u in unit.parse_xml(holder_xml, where=where):
             row = u.convert_to_row(out_dir)
             row['ATTACHMENTS'] = [u.to_xml_file(t)]
             if log_file is not None:
@@ -106,7 +107,10 @@ if __name__ == '__main__':
     parser.add_argument(
         '--audit', '-a',
         help='audit log export')
+    parser.add_argument(
+        '--shard', type=parse_shard,
+        help='convert only shard i of N of the export (by irn), given as i/N')
 
 
     args = parser.parse_args()
-    main(args.input, args.output, log_file=args.audit)
\ No newline at end of file
+    main(args.input, args.output, log_file=args.audit, where=args.shard)
\ No newline at end of file